@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import json
+import os
+import platform
+import re
+import sys
+
+from collections import Counter, defaultdict
+from datetime import datetime
+from math import comb
+
+import numpy as np
+
+from cache import atomic_write
+from ingest import read_json
+from pairs import count_common
+from profiling import Profiler, stage
+from solution import LSH_stream, duplicate_detection, evaluate, load_data, minhash
+
+
+# Numbers in feature values, which CatalogueGenerator perturbs
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+# Words of both letters and digits, such as model numbers, of which CatalogueGenerator makes the rare ones distinct per model
+MODEL_WORD = re.compile(r"[a-zA-Z0-9]*(?:[0-9][a-zA-Z]|[a-zA-Z][0-9])[a-zA-Z0-9]*")
+
+# Numbers with decimals, mostly measurements such as weights and sizes, which CatalogueGenerator changes per model
+DECIMAL = re.compile(r"\d+\.\d+")
+
+
+def _compact(model_id: str) -> str:
+    # Model ID as it often appears in titles, e.g. 29PFL4508F7 for 29PFL4508/F7
+    return re.sub(r"[^0-9a-zA-Z]", "", model_id)
+
+
+class CatalogueGenerator():
+    """
+    Generates synthetic offers in the format of the template file, for catalogues larger than the real one.
+    Every synthetic model is offered by one or more of the shops of the template, which as in the template
+    never offer a model twice. duplicate_rate is the fraction of models offered by more than one shop,
+    by default that of the template. Offers of a model are copies of the offers of a template model
+    offered by at least as many shops, with a new modelID in the title and features.
+    Copies of a template model differ such that as in the template, each model has words of its own,
+    however large the catalogue: model words of at most rare template models get a suffix of the model,
+    and with probability variety, each decimal number of a model is changed by up to 10%,
+    in both cases the same in all its offers.
+    With probability noise, each feature of an offer is dropped, or has its numbers changed by up to 10%,
+    such that duplicates differ too.
+    """
+
+    def __init__(self, template_file: str, duplicate_rate: float = None, noise: float = 0.05, variety: float = 0.5, rare: int = 2,
+                 seed: int = 0):
+        with open(template_file, "r") as file:
+            offers = list(read_json(file))
+
+        self.template_file = template_file
+        self.noise = noise
+        self.variety = variety
+        self.rare = rare
+        self.seed = seed
+
+        self.shops = sorted({offer["shop"] for offer in offers})
+
+        # Offers per template model, per shop
+        self.models: dict[str, dict[str, dict]] = defaultdict(dict)
+        for offer in offers:
+            self.models[offer["modelID"]].setdefault(offer["shop"], offer)
+
+        self.model_ids = list(self.models)
+
+        # Model words of at most rare template models
+        model_words = Counter(word for offers in self.models.values()
+                              for word in {word for offer in offers.values() for value in [offer["title"], *offer["featuresMap"].values()]
+                                           for word in MODEL_WORD.findall(value)})
+        self.rare_words = {word for word, count in model_words.items() if count <= rare}
+
+        # Distribution of the number of shops per model, and template models offered by at least k shops
+        shops_per_model = Counter(len(shops) for shops in self.models.values())
+        self.num_shops = np.arange(1, len(self.shops) + 1)
+        self.num_shops_weights = np.array([shops_per_model[k] for k in self.num_shops], dtype = float)
+
+        self.models_by_num_shops = {k: [model_id for model_id, shops in self.models.items() if len(shops) >= k] for k in self.num_shops}
+
+        if duplicate_rate is None:
+            duplicate_rate = self.num_shops_weights[1:].sum() / self.num_shops_weights.sum()
+
+        self.duplicate_rate = duplicate_rate
+
+    def __str__(self) -> str:
+        return (f"CatalogueGenerator: {len(self.model_ids)} template models from '{self.template_file}', {self.duplicate_rate:.1%} duplicated, "
+                f"noise {self.noise}, variety {self.variety}, rare {self.rare}, seed {self.seed}")
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @staticmethod
+    def _perturb_number(number: str, rng: np.random.Generator) -> str:
+        # Changed by up to 10%, with as many decimals
+        return f"{float(number) * rng.uniform(0.9, 1.1):.{len(number.partition('.')[2])}f}"
+
+    def _perturb(self, value: str, rng: np.random.Generator) -> str:
+        return NUMBER.sub(lambda number: self._perturb_number(number.group(), rng), value)
+
+    def model(self, k: int) -> list[dict]:
+        # Offers of synthetic model k, the same for the same k and seed
+        rng = np.random.default_rng([self.seed, k])
+
+        if rng.random() < self.duplicate_rate:
+            num_shops = rng.choice(self.num_shops[1:], p = self.num_shops_weights[1:] / self.num_shops_weights[1:].sum())
+        else:
+            num_shops = 1
+
+        # Template model with at least num_shops offers, of which num_shops are used
+        candidates = self.models_by_num_shops[num_shops]
+        template_model = self.models[candidates[rng.integers(len(candidates))]]
+        shops = list(rng.choice(list(template_model), size = num_shops, replace = False))
+
+        model_id = f"{template_model[shops[0]]['modelID']}-S{k:x}"
+
+        # Decimal numbers of this model, the same in every shop, filled in by new_word
+        decimals: dict[str, str] = {}
+
+        offers = []
+        for shop in shops:
+            template = template_model[shop]
+
+            # The model ID as is and compacted, rare model words and decimals, in one pass such that the new ID isn't renamed again
+            new_ids = {template["modelID"]: model_id, _compact(template["modelID"]): _compact(model_id)}
+            old_words = re.compile("|".join([*(re.escape(old) for old in sorted(new_ids, key = len, reverse = True)),
+                                             MODEL_WORD.pattern, DECIMAL.pattern]))
+
+            def new_word(old: str) -> str:
+                if old in new_ids:
+                    return new_ids[old]
+
+                if DECIMAL.fullmatch(old):
+                    if old not in decimals:
+                        decimals[old] = self._perturb_number(old, rng) if rng.random() < self.variety else old
+
+                    return decimals[old]
+
+                return f"{old}S{k:x}" if old in self.rare_words else old
+
+            def rename(value: str) -> str:
+                return old_words.sub(lambda old: new_word(old.group()), value)
+
+            features = {}
+            for name, value in template["featuresMap"].items():
+                if rng.random() < self.noise:
+                    if rng.random() < 0.5:
+                        continue
+
+                    if template["modelID"] not in value:
+                        value = self._perturb(value, rng)
+
+                features[name] = rename(value)
+
+            offers.append({"shop": shop, "url": template["url"], "modelID": model_id, "featuresMap": features, "title": rename(template["title"])})
+
+        return offers
+
+    def write(self, filename: str, num_products: int) -> None:
+        # num_products offers, one per line, readable by load_data as .ndjson
+        # Written atomically, such that an interrupted run leaves no partial catalogue
+        def write_offers(file) -> None:
+            written, k = 0, 0
+            while written < num_products:
+                # The last model may lose some of its offers
+                for offer in self.model(k)[:num_products - written]:
+                    file.write(json.dumps(offer) + "\n")
+                    written += 1
+
+                k += 1
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok = True)
+        atomic_write(filename, write_offers)
+
+    def catalogue(self, num_products: int, directory: str = "data/benchmark") -> str:
+        # Filename of a catalogue of num_products, generated unless it exists already,
+        # so the generate stage is only recorded the first time
+        filename = os.path.join(directory, f"synthetic {num_products} {self.duplicate_rate:.3f} {self.noise} {self.variety} {self.rare} {self.seed}.ndjson")
+
+        if not os.path.exists(filename):
+            with stage("generate") as record:
+                self.write(filename, num_products)
+                record.count(products = num_products)
+
+        return filename
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count()}
+
+
+def run_size(generator: CatalogueGenerator, num_products: int, num_hashes: int, all_num_rows: list[int],
+             max_pairs: int = 2_000_000, seed: int = 0, memory: bool = False, compact: bool = False,
+             profile_directory: str = None) -> dict:
+    # Stages of the pipeline on a synthetic catalogue of num_products, and its quality for each num_rows
+    # With profile_directory, the cProfile statistics of the stages are dumped there, see Profiler
+    # With compact, products are loaded into a ProductStore, see load_data, as needed for the largest catalogues
+    # Duplicate detection is skipped for num_rows with more than max_pairs candidates,
+    # as scoring them takes too long to be of use, or without duplicates among them
+    with Profiler(memory = memory, profile_directory = profile_directory) as profiler:
+        filename = generator.catalogue(num_products)
+
+        products, all_duplicates, num_products = load_data(filename, compact = compact)
+        signatures = minhash(products, num_hashes, do_print = False, rng = np.random.default_rng(seed))
+
+        quality = []
+        for num_rows in all_num_rows:
+            print(f"{num_products} products, {num_rows} rows")
+
+            with stage(f"{num_rows} rows"):
+                # Streamed, such that catalogues with more candidates than fit in memory can still be counted
+                # Candidates are only kept while there are at most max_pairs of them
+                kept, num_candidates, TP = [], 0, 0
+
+                with stage("LSH") as record:
+                    for chunk in LSH_stream(signatures, num_hashes // num_rows, num_rows, do_print = False):
+                        num_candidates += len(chunk)
+                        TP += count_common(chunk, all_duplicates, num_products)
+
+                        if num_candidates <= max_pairs:
+                            kept.append(chunk)
+
+                    record.count(pairs = num_candidates)
+
+                row = {"num_rows": num_rows, "candidates": num_candidates, "comparison_ratio": num_candidates / comb(num_products, 2),
+                       "pair_quality": TP / num_candidates if num_candidates else 0,
+                       "pair_completeness": TP / len(all_duplicates) if len(all_duplicates) else 0, "F1": None}
+
+                # Without any duplicate among the candidates there is nothing to train the classifier on
+                if num_candidates <= max_pairs and TP > 0:
+                    candidates = np.concatenate(kept)
+                    final_duplicates, _ = duplicate_detection(products, candidates, all_duplicates, do_print = False)
+                    row["F1"] = evaluate(final_duplicates, all_duplicates, num_products, do_print = False)[2]
+
+                quality.append(row)
+
+    return {"num_products": num_products, "num_duplicates": len(all_duplicates), "quality": quality,
+            "stages": profiler.to_dict(), "totals": profiler.totals().to_dict()}
+
+
+def save(filename: str, data: dict) -> None:
+    atomic_write(filename, lambda file: json.dump(data, file, indent = 4))
+
+
+def run_benchmark(generator: CatalogueGenerator, all_num_products: list[int], num_hashes: int, all_num_rows: list[int],
+                  output_file: str, max_pairs: int = 2_000_000, seed: int = 0, memory: bool = False, compact: bool = False,
+                  profile_directory: str = None) -> dict:
+    # Every size in turn, saved to output_file after each, so finished sizes survive an interrupted run
+    # With profile_directory, the cProfile statistics of each size go to a directory of their own in it
+    data = {"environment": environment(), "generator": str(generator), "num_hashes": num_hashes,
+            "all_num_rows": all_num_rows, "max_pairs": max_pairs, "seed": seed, "compact": compact, "runs": []}
+
+    for num_products in all_num_products:
+        size_directory = os.path.join(profile_directory, f"{num_products} products") if profile_directory is not None else None
+        data["runs"].append(run_size(generator, num_products, num_hashes, all_num_rows, max_pairs, seed, memory, compact, size_directory))
+        save(output_file, data)
+
+    return data
+
+
+def compare(old_file: str, new_file: str) -> None:
+    # Wall time of every stage of every size in both benchmark files, as a ratio new / old
+    with open(old_file) as file:
+        old = {run["num_products"]: run["stages"] for run in json.load(file)["runs"]}
+
+    with open(new_file) as file:
+        new = {run["num_products"]: run["stages"] for run in json.load(file)["runs"]}
+
+    for num_products in sorted(old.keys() & new.keys()):
+        print(f"{num_products} products:")
+
+        for name in new[num_products]:
+            if name in old[num_products]:
+                before, after = old[num_products][name]["wall"], new[num_products][name]["wall"]
+                ratio = after / before if before else float("inf")
+                print(f"    {name}: {before:.3f} s -> {after:.3f} s ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+    # python src/benchmark.py [output file] times the pipeline on synthetic catalogues
+    # python src/benchmark.py compare <old file> <new file> compares the stages of two runs
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit()
+
+    num_hashes = 432
+    all_num_rows = [4, 6, 8, 12]
+    all_num_products = [10_000, 100_000, 1_000_000]
+
+    # Candidates above which duplicate detection is skipped
+    max_pairs = 2_000_000
+
+    # Peak memory as well slows down the run
+    memory = False
+
+    # Products in a ProductStore, without which the 1M catalogue doesn't fit in memory
+    compact = True
+
+    # Directory for cProfile statistics of every stage, e.g. for snakeviz, None to skip
+    profile_directory = None
+
+    generator = CatalogueGenerator("data/TVs-all-merged.json", noise = 0.05, variety = 0.5, seed = 0)
+    print(generator)
+
+    if len(sys.argv) > 1:
+        output_file = sys.argv[1]
+    else:
+        output_file = f"data/benchmark {datetime.now()}.json"
+
+    data = run_benchmark(generator, all_num_products, num_hashes, all_num_rows, output_file, max_pairs = max_pairs,
+                         memory = memory, compact = compact, profile_directory = profile_directory)
+
+    for run in data["runs"]:
+        print(f"{run['num_products']} products:")
+
+        for name, record in run["totals"].items():
+            print(f"    {name}: {record['wall']:.3f} s")
+
+    print(f"Results saved to '{output_file}'")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from item import Item
+from lsh import LSHIndex, unique_sorted
+from pairs import pack_pairs, shop_ids, unpack_pairs
+from profiling import profiled
+from workers import worker_data, worker_pool
+
+
+# What to do with products without a brand:
+# - own: they form one block of their own
+# - each: they are added to every block, for when brands are missing rather than absent
+# - drop: they are in no block, so never become candidates
+BLOCKING_FALLBACKS = ("own", "each", "drop")
+
+
+def blocks(products: list[Item], fallback: str = "own") -> list[np.ndarray]:
+    # Sorted indices of the products in each block, one block per brand as resolved by preprocess
+    if fallback not in BLOCKING_FALLBACKS:
+        raise ValueError(f"Unknown fallback '{fallback}', expected one of {BLOCKING_FALLBACKS}")
+
+    brands: dict[str, list[int]] = {}
+    for i, product in enumerate(products):
+        brands.setdefault(product.brand, []).append(i)
+
+    without_brand = np.array(brands.pop(None, []), dtype = np.int64)
+    result = [np.array(indices, dtype = np.int64) for indices in brands.values()]
+
+    if fallback == "each":
+        result = [np.union1d(block, without_brand) for block in result]
+
+    if fallback in ("own", "each") and len(without_brand) > 0:
+        result.append(without_brand)
+
+    return result
+
+
+def block_pairs(hashes: np.ndarray, shops: np.ndarray, block: np.ndarray, num_rows: int) -> np.ndarray:
+    # LSH candidates within a block, as indices into all products, without pairs from the same shop
+    # hashes are the band hashes of all products, of which those of the block are taken as they are
+    if len(block) < 2:
+        return np.empty((0, 2), dtype = np.int32)
+
+    pairs = block[LSHIndex.from_band_hashes(hashes[:, block], num_rows).candidate_pairs()]
+
+    return pairs[shops[pairs[:, 0]] != shops[pairs[:, 1]]].astype(np.int32)
+
+
+def _block_pairs(block: np.ndarray, num_rows: int) -> np.ndarray:
+    return block_pairs(worker_data("band_hashes"), worker_data("shops"), block, num_rows)
+
+
+@profiled("blocked LSH", lambda result: {"pairs": len(result)})
+def blocked_candidate_pairs(index: LSHIndex, products: list[Item], fallback: str = "own", num_workers: int = 1) -> np.ndarray:
+    # Unique sorted (i, j), i < j, pairs of products of different shops in the same block that share a bucket of index
+    # Pairs across blocks or from one shop are never candidates, as similarity_features gives them 0 anyway
+    # Blocks are independent, with num_workers > 1 they are processed across a process pool
+    shops = shop_ids(products)
+
+    # Largest blocks first, such that the pool isn't waiting on one large block at the end
+    all_blocks = sorted(blocks(products, fallback), key = len, reverse = True)
+
+    if num_workers > 1:
+        with worker_pool(num_workers, band_hashes = index.band_hashes, shops = shops) as executor:
+            all_pairs = list(executor.map(_block_pairs, all_blocks, [index.num_rows] * len(all_blocks)))
+
+    else:
+        all_pairs = [block_pairs(index.band_hashes, shops, block, index.num_rows) for block in all_blocks]
+
+    # Blocks only overlap with the each fallback, but sorting is needed anyway
+    keys = unique_sorted(np.concatenate([np.empty(0, dtype = np.int64), *(pack_pairs(pairs, len(products)) for pairs in all_pairs)]))
+
+    return unpack_pairs(keys, len(products))
@@ -1,129 +1,263 @@
 #!/usr/bin/env python3
 
-from random import choice
+import json
+import os
+import sys
+
+from concurrent.futures import as_completed
+from contextlib import nullcontext
 from datetime import datetime
 
 import numpy as np
 
 from solution import *
-
-num_hashes = 432
-weight = 1.0
-
-# Drop highest divisors, as they all yield 0 TP after LSH anyways
-all_divisors = [i for i in range(1, num_hashes + 1) if num_hashes % i == 0][:8]
-print(f"Testing for num_rows in {all_divisors}")
-
-
-filename = "data/TVs-all-merged.json"
-products, all_duplicates, num_products = load_data(filename)
-
-do_print = False
-
-num_bootstraps = 5
-
-# results[:, :, i] is:
-# i = 0 - comparison ratio
-# i = 1 - precision_star
-# i = 2 - recall_star
-# i = 3 - F1_star
-# i = 4 - precision
-# i = 5 - recall
-# i = 6 - F1
-results = np.empty([num_bootstraps, len(all_divisors), 7])
-
-
-for bootstrap in range(num_bootstraps):
-    print(f"Bootstrap {bootstrap + 1} / {num_bootstraps}")
-
-    bootstrap_train: set[Item] = set()
-
-    for _ in range(len(products)):
-        bootstrap_train.add(choice(tuple(products)))
-
-
-    bootstrap_test: list[Item] = list(set(products) - bootstrap_train)
-    bootstrap_train: list[Item] = list(bootstrap_train)
-
-    all_duplicates_train: set[tuple[Item, Item]] = set()
-    all_duplicates_test: set[tuple[Item, Item]] = set()
-
-    for i, product in enumerate(bootstrap_train):
-        for other_product in bootstrap_train[i + 1:]:
-            if (product, other_product) in all_duplicates or (other_product, product) in all_duplicates:
-                all_duplicates_train.add((product, other_product))
-
-    for i, product in enumerate(bootstrap_test):
-        for other_product in bootstrap_test[i + 1:]:
-            if (product, other_product) in all_duplicates or (other_product, product) in all_duplicates:
-                all_duplicates_test.add((product, other_product))
-
-    num_products_train = len(bootstrap_train)
-    num_products_test = len(bootstrap_test)
-
-    print(f"Train: {num_products_train}, test: {num_products_test}")
-    print(f"All duplicates train: {len(all_duplicates_train)}, all duplicates test: {len(all_duplicates_test)}", end = "\n\n")
-
-    for (divisor_index, num_rows) in enumerate(all_divisors):
-        print(f"{divisor_index + 1} / {len(all_divisors)}: {num_rows} rows")
-
-        num_bands = num_hashes // num_rows
+from cache import atomic_write
+from sampling import BootstrapSplit
+from evaluation import CURVE_COLUMNS, THRESHOLDS
+from profiling import Profiler
+from sweep import RESULT_COLUMNS, Sweep
+from workers import worker_data, worker_pool
+
+
+def run_replicate(products: list[Item], all_duplicates: np.ndarray, num_hashes: int, all_divisors: list[int],
+                  weight: float, method: str, blocking: str, profile: bool, profile_memory: bool, seed: np.random.SeedSequence,
+                  profile_directory: str = None, do_print: bool = False) -> tuple[np.ndarray, np.ndarray, dict]:
+    # Results and curves of one bootstrap, see Sweep.run, and with profile the Profiler.to_dict of its stages
+    # With profile_directory as well, the cProfile statistics of its stages are dumped there, see Profiler
+    # All randomness (sampling and hash functions) comes from seed, so a replicate gives
+    # the same results no matter in which process or order it runs
+    rng = np.random.default_rng(seed)
+
+    with Profiler(memory = profile_memory, profile_directory = profile_directory) if profile else nullcontext() as profiler:
+        split = BootstrapSplit(products, all_duplicates, rng)
 
         if do_print:
-            print(f"(Approximate) LSH Acceptance threshold: {(1 / num_bands) ** (1 / num_rows):.4f}")
+            print(split, end = "\n\n")
+
+        # Signatures are computed once and shared by all divisors
+        sweep = Sweep(split.train, split.test, split.duplicates_train, split.duplicates_test, num_hashes,
+                      weight = weight, rng = rng, method = method, blocking = blocking, do_print = do_print)
+
+        results, curves = sweep.run(all_divisors)
+
+    return results, curves, profiler.to_dict() if profile else None
+
+
+def _run_replicate(replicate: int, seed: np.random.SeedSequence, profile_directory: str) -> tuple[int, tuple[np.ndarray, np.ndarray, dict]]:
+    # Arguments shared by all replicates are sent once per worker process
+    return replicate, run_replicate(*worker_data("replicate_arguments"), seed = seed, profile_directory = profile_directory,
+                                    do_print = worker_data("do_print"))
+
+
+class BootstrapRunner():
+    """
+    Runs bootstrap replicates of the parameter sweep, in parallel across a process pool.
+    Each replicate gets its own generator, spawned from a master SeedSequence.
+    Results are saved to results_file after every finished replicate, and replicates
+    which already have results in that file are skipped, such that a run can be resumed.
+    The precision, recall and F1 at every threshold in THRESHOLDS are saved alongside, to curves_file.
+    blocking is passed on to Sweep.
+    With profile, the time (and with profile_memory the peak memory) of every stage of every replicate
+    is saved to profile_file as well, together with their totals over all replicates.
+    With profile_directory, the cProfile statistics of the stages of every replicate are dumped
+    to a directory per replicate in profile_directory, which implies profile.
+    """
+
+    def __init__(self, products: list[Item], all_duplicates: np.ndarray, num_hashes: int, all_divisors: list[int],
+                 num_bootstraps: int, results_file: str, weight: float = 1, seed: int = 0, num_workers: int = 1,
+                 method: str = "minhash", blocking: str = None, profile: bool = False, profile_memory: bool = False,
+                 profile_directory: str = None, do_print: bool = False):
+        self.products = products
+        self.all_duplicates = all_duplicates
+        self.num_hashes = num_hashes
+        self.all_divisors = all_divisors
+        self.num_bootstraps = num_bootstraps
+        self.results_file = results_file
+        self.curves_file = results_file.removesuffix(".npy") + " curves.npy"
+        self.profile_file = results_file.removesuffix(".npy") + " profile.json"
+        self.weight = weight
+        self.seed = seed
+        self.num_workers = num_workers
+        self.method = method
+        self.blocking = blocking
+        self.profile = profile or profile_memory or profile_directory is not None
+        self.profile_memory = profile_memory
+        self.profile_directory = profile_directory
+        self.do_print = do_print
+
+    def __str__(self) -> str:
+        return f"BootstrapRunner: {self.num_bootstraps} bootstraps of num_rows in {self.all_divisors}, {self.method}, blocking {self.blocking}, seed {self.seed}, {self.num_workers} workers"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def replicate_profile_directory(self, replicate: int) -> str:
+        # Directory of the cProfile statistics of replicate, if any
+        if self.profile_directory is None:
+            return None
+
+        return os.path.join(self.profile_directory, f"replicate {replicate}")
+
+    def seeds(self) -> list[np.random.SeedSequence]:
+        # Replicate i always gets the same seed, regardless of num_bootstraps
+        return np.random.SeedSequence(self.seed).spawn(self.num_bootstraps)
+
+    @staticmethod
+    def _load(filename: str, shape: tuple[int, ...]) -> np.ndarray:
+        # NaN for replicates that haven't finished
+        if not os.path.exists(filename):
+            return np.full(shape, np.nan)
+
+        array = np.load(filename)
+
+        if array.shape != shape:
+            raise ValueError(f"Results in '{filename}' have shape {array.shape}, expected {shape}")
+
+        return array
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        # results[:, :, i] is RESULT_COLUMNS[i], curves[:, :, t, i] is CURVE_COLUMNS[i] at THRESHOLDS[t]
+        results = self._load(self.results_file, (self.num_bootstraps, len(self.all_divisors), len(RESULT_COLUMNS)))
+        curves = self._load(self.curves_file, (self.num_bootstraps, len(self.all_divisors), len(THRESHOLDS), len(CURVE_COLUMNS)))
+
+        return results, curves
+
+    @staticmethod
+    def _save(filename: str, array: np.ndarray) -> None:
+        # Written atomically, such that the file always holds complete results
+        atomic_write(filename, lambda file: np.save(file, array), binary = True)
+
+    def save(self, results: np.ndarray, curves: np.ndarray) -> None:
+        # Curves first, as replicates count as done once they are in the results
+        self._save(self.curves_file, curves)
+        self._save(self.results_file, results)
+
+    def load_profiles(self) -> dict[int, dict]:
+        # Profiler.to_dict of every replicate that has been profiled
+        if not os.path.exists(self.profile_file):
+            return {}
+
+        with open(self.profile_file) as file:
+            return {int(replicate): profile for replicate, profile in json.load(file)["replicates"].items()}
+
+    @staticmethod
+    def aggregate(profiles: dict[int, dict]) -> Profiler:
+        # Stages summed over replicates, still per num_rows
+        profiler = Profiler()
+        for profile in profiles.values():
+            profiler.merge(profile)
+
+        return profiler
+
+    def save_profiles(self, profiles: dict[int, dict]) -> None:
+        # Per replicate, summed over replicates, and summed over replicates and num_rows
+        total = self.aggregate(profiles)
+        data = {"replicates": {str(replicate): profiles[replicate] for replicate in sorted(profiles)},
+                "total": total.to_dict(), "stages": total.totals().to_dict()}
+
+        atomic_write(self.profile_file, lambda file: json.dump(data, file, indent = 4))
+
+    def run(self) -> tuple[np.ndarray, np.ndarray]:
+        results, curves = self.load()
+        profiles = self.load_profiles() if self.profile else {}
+        seeds = self.seeds()
+
+        pending = [replicate for replicate in range(self.num_bootstraps) if np.isnan(results[replicate]).all()]
+        print(f"{self.num_bootstraps - len(pending)} / {self.num_bootstraps} bootstraps done already")
+
+        arguments = (self.products, self.all_duplicates, self.num_hashes, self.all_divisors, self.weight, self.method,
+                     self.blocking, self.profile, self.profile_memory)
+
+        if self.num_workers > 1:
+            with worker_pool(self.num_workers, replicate_arguments = arguments, do_print = self.do_print) as executor:
+                futures = [executor.submit(_run_replicate, replicate, seeds[replicate], self.replicate_profile_directory(replicate))
+                           for replicate in pending]
 
+                for future in as_completed(futures):
+                    replicate, (results[replicate], curves[replicate], profile) = future.result()
+                    self.save(results, curves)
 
-        # Fit model on train data
-        if do_print:
-            print()
-            print("Train data")
+                    if self.profile:
+                        profiles[replicate] = profile
+                        self.save_profiles(profiles)
 
-        signatures_train = minhash(bootstrap_train, num_hashes, do_print = do_print)
+                    print(f"Bootstrap {replicate + 1} / {self.num_bootstraps} done")
 
-        intermediate_duplicates_train = LSH(bootstrap_train, signatures_train, num_bands, num_rows)
+        else:
+            for replicate in pending:
+                print(f"Bootstrap {replicate + 1} / {self.num_bootstraps}")
 
-        comparison_ratio_train = len(intermediate_duplicates_train) / comb(len(bootstrap_train), 2)
+                results[replicate], curves[replicate], profile = run_replicate(*arguments, seed = seeds[replicate],
+                                                                               profile_directory = self.replicate_profile_directory(replicate),
+                                                                               do_print = self.do_print)
+                self.save(results, curves)
 
-        if do_print:
-            print(f"Comparison ratio: {comparison_ratio_train:.1%}")
+                if self.profile:
+                    profiles[replicate] = profile
+                    self.save_profiles(profiles)
 
-        precision_star, recall_star, F1_star = evaluate(intermediate_duplicates_train, all_duplicates_train, num_products_train, do_print = do_print)
+                print()
 
-        # Can't do logit if we have 0 TP in training data
-        if precision_star != 0:
-            _, predictor = duplicate_detection(intermediate_duplicates_train, all_duplicates_train, weight = weight, do_print = do_print)
+        return results, curves
 
-        else:
-            results[bootstrap][divisor_index] = [comparison_ratio_train, 0, 0, 0, 0, 0, 0]
-            continue
 
+if __name__ == "__main__":
+    num_hashes = 432
+    weight = 1.0
 
-        # Apply model to testing data
-        if do_print:
-            print()
-            print("Test data")
+    # Drop highest divisors, as they all yield 0 TP after LSH anyways
+    all_divisors = [i for i in range(1, num_hashes + 1) if num_hashes % i == 0][:8]
+    print(f"Testing for num_rows in {all_divisors}")
 
-        signatures_test = minhash(bootstrap_test, num_hashes, do_print = do_print)
 
-        intermediate_duplicates_test = LSH(bootstrap_test, signatures_test, num_bands, num_rows)
+    filename = "data/TVs-all-merged.json"
+    products, all_duplicates, num_products = load_data(filename)
 
-        precision_star, recall_star, F1_star = evaluate(intermediate_duplicates_test, all_duplicates_test, num_products_test, do_print = do_print)
+    num_bootstraps = 5
+    num_workers = os.cpu_count()
+    seed = 0
 
-        comparison_ratio_test = len(intermediate_duplicates_test) / comb(len(bootstrap_test), 2)
+    # LSH within blocks of products of the same brand, with this fallback for products without one,
+    # see blocking.py, None for LSH over all products
+    blocking = None
 
-        if do_print:
-            print(f"Comparison ratio: {comparison_ratio_test:.1%}")
+    # Time every stage, peak memory as well slows down the run
+    profile = True
+    profile_memory = False
 
-        final_duplicates, _ = duplicate_detection(intermediate_duplicates_test, all_duplicates_test, predictor = predictor, do_print = do_print)
+    # Directory for cProfile statistics of every stage, e.g. for snakeviz, None to skip
+    profile_directory = None
 
-        precision, recall, F1 = evaluate(final_duplicates, all_duplicates_test, num_products_test, do_print = do_print)
+    # Pass the results file of an interrupted run to resume it
+    if len(sys.argv) > 1:
+        results_file = sys.argv[1]
+    else:
+        results_file = f"data/bootstrap {datetime.now()}-{all_divisors}.npy"
 
+    runner = BootstrapRunner(products, all_duplicates, num_hashes, all_divisors, num_bootstraps, results_file,
+                             weight = weight, seed = seed, num_workers = num_workers, blocking = blocking,
+                             profile = profile, profile_memory = profile_memory, profile_directory = profile_directory)
+    print(runner)
 
-        results[bootstrap][divisor_index] = [comparison_ratio_test, precision_star, recall_star, F1_star, precision, recall, F1]
+    # results[:, :, i] is:
+    # i = 0 - comparison ratio
+    # i = 1 - precision_star
+    # i = 2 - recall_star
+    # i = 3 - F1_star
+    # i = 4 - precision
+    # i = 5 - recall
+    # i = 6 - F1
+    results, curves = runner.run()
 
-        if do_print:
-            print()
+    # Best threshold per num_rows, on the curves averaged over bootstraps
+    mean_F1 = np.mean(curves[:, :, :, CURVE_COLUMNS.index("F1")], axis = 0)
+    for num_rows, F1 in zip(all_divisors, mean_F1):
+        print(f"{num_rows} rows: best threshold {THRESHOLDS[np.argmax(F1)]:.2f}, F1 {F1.max():.2%}")
 
-    print()
+    print(f"Results saved to '{results_file}', curves to '{runner.curves_file}'")
 
-np.save(f"data/bootstrap {datetime.now()}-{all_divisors}.npy", results)
+    if profile:
+        print()
+        print("Stages over all bootstraps:")
+        print(runner.aggregate(runner.load_profiles()).totals())
+        print(f"Profile saved to '{runner.profile_file}'")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+from collections.abc import Callable
+from typing import IO
+
+from scipy.sparse import csr_matrix, load_npz, save_npz
+
+from item import Item
+
+
+# Bump when the cached contents change meaning, e.g. a different preprocessing or hashing scheme
+CACHE_VERSION = 2
+
+
+def file_digest(filename: str) -> str:
+    digest = hashlib.sha256()
+
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def umask_mode(mode: int) -> int:
+    # mode with the process umask applied, as open and mkdir do, unlike mkstemp and mkdtemp
+    umask = os.umask(0)
+    os.umask(umask)
+    return mode & ~umask
+
+
+def atomic_write(filename: str, write: Callable[[IO], None], binary: bool = False) -> None:
+    # Calls write with a temporary file next to filename, which then replaces filename,
+    # such that filename always holds either its old or its complete new contents
+    directory = os.path.dirname(filename) or "."
+    descriptor, temporary = tempfile.mkstemp(prefix = ".", suffix = os.path.splitext(filename)[1], dir = directory)
+
+    try:
+        with os.fdopen(descriptor, "wb" if binary else "w") as file:
+            write(file)
+
+        # Readable by others as far as the umask allows, as if written by open
+        os.chmod(temporary, umask_mode(0o666))
+        os.replace(temporary, filename)
+
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+class CachedRun():
+    """
+    Everything computed from a data file up to and including the signatures
+    """
+
+    def __init__(self, products: list[Item], all_duplicates: np.ndarray, vocabulary: list[str],
+                 binary_data: csr_matrix, signatures: np.ndarray):
+        self.products = products
+        self.all_duplicates = all_duplicates
+        self.vocabulary = vocabulary
+        self.binary_data = binary_data
+        self.signatures = signatures
+
+    def __str__(self) -> str:
+        return f"CachedRun: {len(self.products)} products, {len(self.vocabulary)} components, {self.signatures.shape[0]} hashes"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class PipelineCache():
+    """
+    Content-addressed on-disk cache of preprocessed products, binary matrices and signatures.
+    Entries are directories named after a hash of the input file and the parameters,
+    and the least recently used entries are evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, directory: str = "data/cache", max_bytes: int = 1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok = True)
+
+    def __str__(self) -> str:
+        return f"PipelineCache: '{self.directory}', {len(self.keys())} entries, {self.size() / 1e6:.1f} / {self.max_bytes / 1e6:.1f} MB"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @staticmethod
+    def key(filename: str, filter_num: int, num_hashes: int, seed: int, method: str = "minhash") -> str:
+        parameters = json.dumps({
+            "file": file_digest(filename),
+            "filter_num": filter_num,
+            "num_hashes": num_hashes,
+            "seed": seed,
+            "method": method,
+            "version": CACHE_VERSION,
+        }, sort_keys = True)
+
+        return hashlib.sha256(parameters.encode()).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def keys(self) -> list[str]:
+        return [key for key in os.listdir(self.directory) if not key.startswith(".")]
+
+    def entry_size(self, key: str) -> int:
+        path = self.path(key)
+
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def size(self) -> int:
+        return sum(self.entry_size(key) for key in self.keys())
+
+    def load(self, key: str) -> CachedRun:
+        # None if there is no entry for key
+        path = self.path(key)
+
+        if not os.path.isdir(path):
+            return None
+
+        with open(os.path.join(path, "products.pkl"), "rb") as file:
+            products = pickle.load(file)
+
+        with open(os.path.join(path, "vocabulary.json"), "r") as file:
+            vocabulary = json.load(file)
+
+        result = CachedRun(
+            products,
+            np.load(os.path.join(path, "all_duplicates.npy")),
+            vocabulary,
+            load_npz(os.path.join(path, "binary.npz")).tocsr(),
+            np.load(os.path.join(path, "signatures.npy"), mmap_mode = "r"),
+        )
+
+        # Mark as recently used, for eviction
+        os.utime(path)
+
+        return result
+
+    def store(self, key: str, run: CachedRun) -> None:
+        # Written to a temporary directory first, such that entries are either complete or absent
+        temporary = tempfile.mkdtemp(prefix = ".", dir = self.directory)
+
+        try:
+            with open(os.path.join(temporary, "products.pkl"), "wb") as file:
+                pickle.dump(run.products, file, protocol = pickle.HIGHEST_PROTOCOL)
+
+            with open(os.path.join(temporary, "vocabulary.json"), "w") as file:
+                json.dump(run.vocabulary, file)
+
+            np.save(os.path.join(temporary, "all_duplicates.npy"), run.all_duplicates)
+            save_npz(os.path.join(temporary, "binary.npz"), run.binary_data)
+            np.save(os.path.join(temporary, "signatures.npy"), np.asarray(run.signatures))
+
+            os.chmod(temporary, umask_mode(0o777))
+            self.invalidate(key)
+            os.rename(temporary, self.path(key))
+
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors = True)
+            raise
+
+        self.evict(keep = key)
+
+    def invalidate(self, key: str = None) -> None:
+        # Remove the entry for key, or all entries if no key is given
+        for entry in ([key] if key is not None else self.keys()):
+            shutil.rmtree(self.path(entry), ignore_errors = True)
+
+    def evict(self, keep: str = None) -> None:
+        # Remove least recently used entries until the cache fits in max_bytes
+        sizes = {key: self.entry_size(key) for key in self.keys()}
+        total = sum(sizes.values())
+
+        for key in sorted(sizes, key = lambda key: os.path.getmtime(self.path(key))):
+            if total <= self.max_bytes:
+                break
+
+            if key == keep:
+                continue
+
+            self.invalidate(key)
+            total -= sizes[key]
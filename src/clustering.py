@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from item import Item
+from pairs import shop_ids, value_ids
+from profiling import profiled
+
+
+def connected_clusters(pairs: np.ndarray, num_products: int) -> np.ndarray:
+    # Cluster label of each product, products are in the same cluster if they are connected by pairs
+    graph = coo_matrix((np.ones(len(pairs), dtype = bool), (pairs[:, 0], pairs[:, 1])), shape = (num_products, num_products))
+
+    return connected_components(graph, directed = False)[1]
+
+
+def true_clusters(products: list[Item]) -> np.ndarray:
+    # Cluster label of each product according to the modelIDs, the ground truth of load_data
+    return value_ids(product.id for product in products)
+
+
+class UnionFind():
+    """
+    Disjoint sets of products, with the set of shops in each as a bitmask,
+    such that sets are only merged if they have no shop in common
+    """
+
+    def __init__(self, shops: np.ndarray):
+        self.parent = list(range(len(shops)))
+        self.shops = [1 << int(shop) for shop in shops]
+
+    def __str__(self) -> str:
+        return f"UnionFind: {len(self.parent)} products, {sum(i == parent for i, parent in enumerate(self.parent))} sets"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        # Path compression
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+
+        return root
+
+    def union(self, i: int, j: int) -> bool:
+        # Whether i and j are in the same set afterwards
+        i, j = self.find(i), self.find(j)
+
+        if i == j:
+            return True
+
+        if self.shops[i] & self.shops[j]:
+            return False
+
+        self.parent[j] = i
+        self.shops[i] |= self.shops[j]
+
+        return True
+
+
+@profiled("clustering", lambda result: {"products": len(result)})
+def clusters(pairs: np.ndarray, products: list[Item], scores: np.ndarray = None) -> np.ndarray:
+    # Cluster label of each product, with at most one product per shop in each cluster
+    # Connected components without conflicts are clusters as they are. Only the components
+    # with a shop more than once are rebuilt with a union-find over their pairs, most likely
+    # duplicates (highest scores, or the given order without scores) first, skipping the
+    # pairs that would put a shop in a cluster twice
+    num_products = len(products)
+    shops = shop_ids(products)
+
+    labels = connected_clusters(pairs, num_products)
+
+    if len(pairs) == 0:
+        return labels
+
+    # Components with a shop more than once
+    num_shops = shops.max() + 1
+    per_shop = np.bincount(labels * num_shops + shops, minlength = (labels.max() + 1) * num_shops)
+    conflicted = np.flatnonzero((per_shop.reshape(-1, num_shops) > 1).any(axis = 1))
+
+    if len(conflicted) == 0:
+        return labels
+
+    in_conflict = np.isin(labels[pairs[:, 0]], conflicted)
+    conflict_pairs = pairs[in_conflict]
+
+    if scores is not None:
+        conflict_pairs = conflict_pairs[np.argsort(-scores[in_conflict], kind = "stable")]
+
+    union_find = UnionFind(shops)
+    for i, j in conflict_pairs.tolist():
+        union_find.union(i, j)
+
+    # Products in conflicted components get new labels after the existing ones
+    members = np.flatnonzero(np.isin(labels, conflicted))
+    roots = np.array([union_find.find(i) for i in members.tolist()], dtype = np.int64)
+
+    labels = labels.copy()
+    labels[members] = labels.max() + 1 + np.unique(roots, return_inverse = True)[1].ravel()
+
+    # Consecutive labels again
+    return np.unique(labels, return_inverse = True)[1].ravel()
+
+
+def evaluate_clusters(labels: np.ndarray, true_labels: np.ndarray, do_print: bool = True) -> tuple[float, float, float, float, float]:
+    # (pair precision, pair recall, pair F1, cluster precision, cluster recall) of labels against true_labels
+    # Pair metrics count all pairs within the same cluster. Cluster precision is the fraction of clusters of
+    # two or more products that exactly equal a true cluster, cluster recall the fraction of true clusters
+    # of two or more products that are found exactly
+    # Sizes of each (cluster, true cluster) overlap from one unique over the label combinations
+    combined, overlap = np.unique(np.stack([labels, true_labels], axis = 1), axis = 0, return_counts = True)
+
+    sizes = np.bincount(labels)
+    true_sizes = np.bincount(true_labels)
+
+    TP = int((overlap * (overlap - 1) // 2).sum())
+    found = int((sizes * (sizes - 1) // 2).sum())
+    actual = int((true_sizes * (true_sizes - 1) // 2).sum())
+
+    precision = TP / found if found else 0
+    recall = TP / actual if actual else 0
+    F1 = 2 * precision * recall / (precision + recall) if precision + recall else 0
+
+    # A cluster equals a true cluster if their overlap is both of them entirely
+    exact = (overlap == sizes[combined[:, 0]]) & (overlap == true_sizes[combined[:, 1]]) & (overlap > 1)
+
+    num_clusters = int((sizes > 1).sum())
+    num_true_clusters = int((true_sizes > 1).sum())
+
+    cluster_precision = float(exact.sum() / num_clusters) if num_clusters else 0
+    cluster_recall = float(exact.sum() / num_true_clusters) if num_true_clusters else 0
+
+    if do_print:
+        print(f"Clusters: {num_clusters} found, {num_true_clusters} true, {exact.sum()} exactly right")
+        print(f"Pair precision: {precision:.2%}, pair recall: {recall:.2%}, pair F1: {F1:.2%}")
+        print(f"Cluster precision: {cluster_precision:.2%}, cluster recall: {cluster_recall:.2%}")
+
+    return precision, recall, F1, cluster_precision, cluster_recall
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from pairs import pair_labels
+
+
+# Thresholds at which bootstrap.py stores the curves
+THRESHOLDS = np.linspace(0, 1, 101)
+
+# Columns of ThresholdCurve.at
+CURVE_COLUMNS = ("precision", "recall", "F1")
+
+
+def f1_score(precision: np.ndarray, recall: np.ndarray) -> np.ndarray:
+    # 0 where both are 0
+    total = precision + recall
+
+    return np.divide(2 * precision * recall, total, out = np.zeros_like(total, dtype = float), where = total != 0)
+
+
+class ThresholdCurve():
+    """
+    Precision, recall and F1 of classifying candidate pairs as duplicates for every threshold on their scores,
+    from one sort of the scores and cumulative counts of true and false positives.
+    A pair is classified as duplicate if its score exceeds the threshold, as in duplicate_detection.
+    Pair quality and pair completeness are those of the candidates themselves, before classification.
+    """
+
+    def __init__(self, pairs: np.ndarray, scores: np.ndarray, all_duplicates: np.ndarray, num_products: int):
+        order = np.argsort(-scores, kind = "stable")
+        labels = pair_labels(pairs, all_duplicates, num_products)[order]
+
+        # Scores in decreasing order, and the number of true/false positives among the first k pairs
+        self.scores = scores[order]
+        self.TP = np.r_[0, np.cumsum(labels)]
+        self.FP = np.r_[0, np.cumsum(~labels)]
+
+        self.num_candidates = len(pairs)
+        self.num_duplicates = len(all_duplicates)
+
+        # Pair quality: duplicates per comparison, pair completeness: fraction of duplicates among the candidates
+        self.pair_quality = self.TP[-1] / self.num_candidates if self.num_candidates else 0
+        self.pair_completeness = self.TP[-1] / self.num_duplicates if self.num_duplicates else 0
+
+    def __str__(self) -> str:
+        threshold, _, _, F1 = self.best()
+
+        return f"ThresholdCurve: {self.num_candidates} candidates, PQ {self.pair_quality:.2%}, PC {self.pair_completeness:.1%}, best F1 {F1:.2%} at {threshold:.3f}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def _metrics(self, found: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Precision, recall and F1 of classifying the first found pairs as duplicates
+        TP, FP = self.TP[found], self.FP[found]
+
+        precision = np.divide(TP, TP + FP, out = np.zeros(len(found)), where = TP + FP != 0)
+        recall = TP / self.num_duplicates if self.num_duplicates else np.zeros(len(found))
+
+        return precision, recall, f1_score(precision, recall)
+
+    def at(self, thresholds: np.ndarray) -> np.ndarray:
+        # Shape (len(thresholds), len(CURVE_COLUMNS))
+        # Number of scores exceeding each threshold, scores are in decreasing order
+        found = np.searchsorted(-self.scores, -np.asarray(thresholds, dtype = float), side = "left")
+
+        return np.stack(self._metrics(found), axis = 1)
+
+    def best(self) -> tuple[float, float, float, float]:
+        # (threshold, precision, recall, F1) with the highest F1 over all thresholds
+        # Every distinct score is a possible cut, as threshold halfway to the next score
+        last = np.flatnonzero(np.r_[self.scores[1:] != self.scores[:-1], True]) + 1
+        precision, recall, F1 = self._metrics(last)
+
+        if len(last) == 0 or F1.max() == 0:
+            return 1.0, 0.0, 0.0, 0.0
+
+        i = int(np.argmax(F1))
+        cut = last[i]
+        threshold = (self.scores[cut - 1] + self.scores[cut]) / 2 if cut < len(self.scores) else self.scores[cut - 1] / 2
+
+        return float(threshold), float(precision[i]), float(recall[i]), float(F1[i])
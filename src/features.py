@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from difflib import SequenceMatcher
+from collections import OrderedDict
+
+import jellyfish
+
+from item import Item
+from pairs import pack_pairs, shop_ids, value_ids
+from profiling import profiled
+from workers import worker_data, worker_pool
+
+
+# Columns of the feature matrix
+FEATURE_NAMES = ("SequenceMatcher", "Jaro-Winkler")
+
+
+def comparable_mask(products: list[Item], pairs: np.ndarray) -> np.ndarray:
+    # Pairs from different shops with the same brand (or both without brand)
+    # All other pairs are certainly not duplicates and get similarity 0
+    shops = shop_ids(products)
+    brands = value_ids(product.brand for product in products)
+
+    first, second = pairs[:, 0], pairs[:, 1]
+
+    return (shops[first] != shops[second]) & (brands[first] == brands[second])
+
+
+class SimilarityCache():
+    """
+    Bounded LRU cache of similarity scores, keyed by packed (i, j) product index pairs.
+    Keys are only meaningful for one products list, so use one cache per list.
+    """
+
+    def __init__(self, max_size: int = 1_000_000):
+        self.max_size = max_size
+
+        self.scores: OrderedDict[int, np.ndarray] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __str__(self) -> str:
+        return f"SimilarityCache: {len(self)} / {self.max_size} entries, {self.hits} hits, {self.misses} misses"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def get(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Mask of cached keys and the scores of those keys
+        found = np.zeros(len(keys), dtype = bool)
+        scores = []
+
+        for k, key in enumerate(keys.tolist()):
+            if key in self.scores:
+                self.scores.move_to_end(key)
+                scores.append(self.scores[key])
+                found[k] = True
+
+        self.hits += int(found.sum())
+        self.misses += len(keys) - int(found.sum())
+
+        return found, np.array(scores).reshape(-1, len(FEATURE_NAMES))
+
+    def put(self, keys: np.ndarray, scores: np.ndarray) -> None:
+        for key, score in zip(keys.tolist(), scores):
+            self.scores[key] = score
+            self.scores.move_to_end(key)
+
+        while len(self.scores) > self.max_size:
+            self.scores.popitem(last = False)
+
+
+def similarity_inputs(products: list[Item]) -> tuple[list[tuple[str, ...]], list[str]]:
+    # Compact per-product inputs of the similarity scores, as cached by Item.cache_similarity_inputs
+    representations = [product.sorted_representation for product in products]
+    titles = [product.normalized_title for product in products]
+
+    return representations, titles
+
+
+def score_pairs(inputs: tuple[list[tuple[str, ...]], list[str]], pairs: np.ndarray) -> np.ndarray:
+    # SequenceMatcher ratio of the set representations and Jaro-Winkler similarity of the titles,
+    # only meaningful for comparable pairs (see comparable_mask)
+    representations, titles = inputs
+
+    result = np.empty([len(pairs), len(FEATURE_NAMES)])
+
+    for k, (i, j) in enumerate(pairs):
+        result[k, 0] = SequenceMatcher(None, representations[i], representations[j]).ratio()
+        result[k, 1] = jellyfish.jaro_winkler_similarity(titles[i], titles[j])
+
+    return result
+
+
+def _score_chunk(pairs: np.ndarray) -> np.ndarray:
+    return score_pairs(worker_data("similarity_inputs"), pairs)
+
+
+@profiled("features", lambda result: {"pairs": len(result)})
+def similarity_features(products: list[Item], pairs: np.ndarray, num_workers: int = 1, chunk_size: int = 10_000,
+                        cache: SimilarityCache = None) -> np.ndarray:
+    # Similarity scores of all pairs in one pass, shape (num_pairs, len(FEATURE_NAMES))
+    # With num_workers > 1, the pairs are scored in chunks of chunk_size pairs across a process pool
+    # Scores found in cache are reused, newly calculated scores are added to it
+    result = np.zeros([len(pairs), len(FEATURE_NAMES)])
+
+    comparable = np.flatnonzero(comparable_mask(products, pairs))
+
+    if cache is not None:
+        keys = pack_pairs(pairs[comparable], len(products))
+
+        found, scores = cache.get(keys)
+        result[comparable[found]] = scores
+
+        comparable = comparable[~found]
+        keys = keys[~found]
+
+    if len(comparable) == 0:
+        return result
+
+    inputs = similarity_inputs(products)
+
+    if num_workers > 1 and len(comparable) > chunk_size:
+        chunks = [pairs[comparable[start:start + chunk_size]] for start in range(0, len(comparable), chunk_size)]
+
+        with worker_pool(num_workers, similarity_inputs = inputs) as executor:
+            result[comparable] = np.concatenate(list(executor.map(_score_chunk, chunks)))
+
+    else:
+        result[comparable] = score_pairs(inputs, pairs[comparable])
+
+    if cache is not None:
+        cache.put(keys, result[comparable])
+
+    return result
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import json
+import numpy as np
+
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from itertools import combinations, islice
+from typing import TextIO
+
+from item import Item
+from normalize import normalize_products
+
+
+# Readers yield the raw offers (dicts with modelID, featuresMap, shop and title) in a file
+Reader = Callable[[TextIO], Iterator[dict]]
+
+
+class _Buffer():
+    """
+    Growing window on a text file, for parsing JSON values one at a time
+    """
+
+    def __init__(self, file: TextIO, read_size: int):
+        self.file = file
+        self.read_size = read_size
+
+        self.text = ""
+        self.position = 0
+        self.eof = False
+
+    def read(self, at_least: int = 0) -> bool:
+        # Drop consumed text and read more, False at end of file
+        if self.eof:
+            return False
+
+        self.text = self.text[self.position:]
+        self.position = 0
+
+        chunk = self.file.read(max(self.read_size, at_least))
+        self.eof = len(chunk) == 0
+        self.text += chunk
+
+        return not self.eof
+
+    def skip_whitespace(self) -> None:
+        while True:
+            while self.position < len(self.text) and self.text[self.position].isspace():
+                self.position += 1
+
+            if self.position < len(self.text) or not self.read():
+                return
+
+    def expect(self, characters: str) -> str:
+        # Consume one of characters
+        self.skip_whitespace()
+
+        if self.position >= len(self.text) or self.text[self.position] not in characters:
+            found = self.text[self.position:self.position + 20] if self.position < len(self.text) else "end of file"
+            raise ValueError(f"Expected one of '{characters}', found '{found}'")
+
+        self.position += 1
+
+        return self.text[self.position - 1]
+
+    def value(self, decoder: json.JSONDecoder):
+        # Decode the next JSON value, reading until it is complete
+        self.skip_whitespace()
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.position)
+
+                # A number at the end of the buffer may continue in the next read
+                if end < len(self.text) or self.eof:
+                    self.position = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            # Double the buffer, such that large values don't get re-parsed many times
+            self.read(at_least = len(self.text))
+
+
+def read_json(file: TextIO, read_size: int = 1 << 20) -> Iterator[dict]:
+    # Top-level mapping of modelID -> list of offers, as in TVs-all-merged.json
+    # Parsed one modelID at a time, so memory is bounded by the largest offer list
+    decoder = json.JSONDecoder()
+    buffer = _Buffer(file, read_size)
+
+    buffer.expect("{")
+
+    buffer.skip_whitespace()
+    if buffer.position < len(buffer.text) and buffer.text[buffer.position] == "}":
+        return
+
+    while True:
+        buffer.value(decoder)
+        buffer.expect(":")
+
+        yield from buffer.value(decoder)
+
+        if buffer.expect(",}") == "}":
+            return
+
+
+def read_ndjson(file: TextIO) -> Iterator[dict]:
+    # One offer per line, as our scraped feeds arrive
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS: dict[str, Reader] = {
+    "json": read_json,
+    "ndjson": read_ndjson,
+}
+
+# File extensions for which another reader than "json" is used by default
+EXTENSIONS = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+
+def register_reader(name: str, reader: Reader, extensions: list[str] = ()) -> None:
+    READERS[name] = reader
+
+    for extension in extensions:
+        EXTENSIONS[extension] = name
+
+
+class StreamingLoader():
+    """
+    Loads products from a file in batches of Items, keeping track of the products
+    per modelID along the way, such that the duplicates are known once all batches are loaded.
+    Product indices count up over all batches.
+    """
+
+    def __init__(self, filename: str, batch_size: int = 1000, reader: str = None):
+        if reader is None:
+            reader = next((name for extension, name in EXTENSIONS.items() if filename.endswith(extension)), "json")
+
+        if reader not in READERS:
+            raise ValueError(f"Unknown reader '{reader}', expected one of {list(READERS)}")
+
+        self.filename = filename
+        self.batch_size = batch_size
+        self.reader = reader
+
+        # modelID -> indices of products with that modelID
+        self.model_indices: defaultdict[str, list[int]] = defaultdict(list)
+        self.num_products = 0
+
+    def __str__(self) -> str:
+        return f"StreamingLoader: '{self.filename}' ({self.reader}), {self.num_products} products loaded"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def batches(self) -> Iterator[list[Item]]:
+        with open(self.filename, "r") as file:
+            offers = READERS[self.reader](file)
+
+            while True:
+                batch = list(islice(offers, self.batch_size))
+
+                if not batch:
+                    return
+
+                items = [Item.from_normalized(product) for product in normalize_products(batch)]
+
+                for item in items:
+                    self.model_indices[item.id].append(self.num_products)
+                    self.num_products += 1
+
+                yield items
+
+    def duplicates(self) -> np.ndarray:
+        # All (i, j) index pairs of products with the same modelID, indices are increasing so i < j already
+        return np.array([
+            pair for indices in self.model_indices.values() for pair in combinations(indices, 2)
+        ], dtype = np.int32).reshape(-1, 2)
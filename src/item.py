@@ -1,19 +1,14 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import numpy as np
-import re
 
-from scipy.sparse import lil_matrix
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, spmatrix
 from random import randint
-from collections import defaultdict
 
+from normalize import NormalizedProduct, parse_numbers
+from profiling import profiled
+from signatures import EMPTY_SIGNATURE, SIGNATURE_METHODS, one_permutation_signatures
 
-def parse_numbers(string: str) -> list[float]:
-    # Matches 1.2, 1., 1 and .2
-    # Will have some false positives but I don't get how python re
-    # works with groups so ykno it's fine
-    occurrences = re.findall(r"\.?\d+\.?\d*", string)
-    return [float(i) for i in occurrences]
 
 def custom_hash(x, a, b):
     # Some large prime
@@ -22,39 +17,37 @@ def custom_hash(x, a, b):
     return a + b * x % p
 
 
-def replace_all(string: str, keys: list[str], to: str) -> str:
-    for key in keys:
-        string = string.replace(key, to)
-
-    return string
-
-
 class Item():
     """
     Simple class to make working with items a bit easier
     """
 
+    # No per-instance dict, attributes set during preprocessing are declared here as well
+    __slots__ = ("id", "shop", "title", "features", "weight", "diagonal", "refresh_rate", "brand", "components",
+                 "weight_quantile", "diagonal_quantile", "set_representation", "sorted_representation", "normalized_title")
+
     def __init__(self, model_id: str, features: dict[str, str], shop: str, title: str):
-        self.id = model_id
+        self.set_normalized(NormalizedProduct(model_id, features, shop, title))
 
-        self.shop = shop.lower()
+    @staticmethod
+    def from_normalized(product: NormalizedProduct) -> Item:
+        item = Item.__new__(Item)
+        item.set_normalized(product)
 
-        self.title = replace_all(
-                        replace_all(title, ['"', " inch", "-inch", "inches", "Inch", "-Inch", " Inch"], "inch"),
-                        ["hertz", "hz", " hz", "Hertz", "Hz", "Hz"], "hz").lower().strip()
+        return item
 
-        self.features = {
-            key.lower().replace(":", ""):
-                replace_all(
-                    replace_all(val, ['"', " inch", "-inch", "inches", "Inch", "-Inch", " Inch"], "inch"),
-                    ["hertz", "hz", " hz", "Hertz", "Hz", "Hz"], "hz").lower().strip()
+    def set_normalized(self, product: NormalizedProduct) -> None:
+        self.id = product.model_id
+        self.shop = product.shop
+        self.title = product.title
+        self.features = product.features
 
-            for key, val in features.items()
-        }
+        # Title and feature value components, found while normalising
+        self.components = product.components
 
         self.weight = self.get_weight()
         self.diagonal = self.get_diagonal()
-        self.refresh_rate = self.get_refresh_rate()
+        self.refresh_rate = product.refresh_rate
         self.brand = self.get_brand()
 
     def __str__(self) -> str:
@@ -90,16 +83,6 @@ class Item():
 
         return None
 
-    def get_refresh_rate(self) -> float:
-        match_string = r"\d+\s?[Hh][Zz]"
-
-        for value in self.features.values():
-            if re.search(match_string, value):
-                # Min should be fine, since we're only comparing quantiles
-                return min(parse_numbers(re.search(match_string, value).string))
-
-        return None
-
     def get_diagonal(self) -> float:
         shop_map = {
             "bestbuy.com": ["screen size class", "screen size (measured diagonally)"],
@@ -130,18 +113,7 @@ class Item():
 
 
     def find_set_representation(self, max_len: int = 10) -> None:
-        result = set()
-
-        regex_words = r"([a-zA-Z0-9]*(([0-9]+[^0-9, ]+)|([^0-9, ]+[0-9]+))[a-zA-Z0-9]*)"
-        regex_number_unit = r"(\d+(\.\d+)?[a-zA-Z]+|^\d+(\.\d+)?)"
-
-        for match in re.finditer(regex_words, self.title):
-            result.add(match.group().strip())
-
-        for val in self.features.values():
-            for match in re.finditer(regex_number_unit, val):
-                result.add(match.group().strip())
-
+        result = set(self.components)
 
         if self.weight_quantile is not None:
             result.add(f"Weight {self.weight_quantile}")
@@ -158,113 +130,186 @@ class Item():
         self.set_representation = result
 
 
+    def cache_similarity_inputs(self) -> None:
+        # Inputs of the similarity scores, which would otherwise be recomputed for every pair
+        # Has to be called again whenever set_representation changes
+        self.sorted_representation = tuple(sorted(self.set_representation))
+        self.normalized_title = self.title.replace(" ", "").lower()
+
+
     # Class methods below here
 
-    # Calculates quantiles for weight and diagonal size
+    # Boundaries of the weight and diagonal size quantiles of a catalogue
     @staticmethod
-    def calc_quantiles(products: list[Item]) -> None:
+    def quantile_boundaries(products: list[Item]) -> tuple[np.ndarray, np.ndarray]:
         weights = [product.weight for product in products if product.weight is not None]
         diagonals = [product.diagonal for product in products if product.diagonal is not None]
 
         weight_quantiles = np.quantile(weights, [0.1, 0.3, 0.5, 0.7, 0.9])
         diagonal_quantiles = np.quantile(diagonals, [0.1, 0.3, 0.5, 0.7, 0.9])
 
+        return weight_quantiles, diagonal_quantiles
+
+    # Brands of a catalogue, sorted such that finding brands in titles doesn't depend on set ordering
+    @staticmethod
+    def known_brands(products: list[Item]) -> list[str]:
+        return sorted({product.brand for product in products if product.brand})
+
+    @staticmethod
+    def prepare(products: list[Item], weight_quantiles: np.ndarray, diagonal_quantiles: np.ndarray, brands: list[str]) -> None:
+        # Quantiles, brands found in titles and set representations of products, against the
+        # quantile boundaries and brands of a catalogue, which need not include these products
         for product in products:
             product.weight_quantile = np.searchsorted(weight_quantiles, product.weight) if product.weight is not None else None
 
             product.diagonal_quantile = np.searchsorted(diagonal_quantiles, product.diagonal) if product.diagonal is not None else None
 
+        # Find brands for products which it wasn't found yet
+        for product in products:
+            if not product.brand:
+                for brand in brands:
+                    if brand in product.title:
+                        product.brand = brand
+                        break
 
-    @staticmethod
-    def minhash(products: list[Item], filter_num: int, do_print = True) -> lil_matrix:
-        representations = [product.set_representation for product in products]
+        # Get representation as set
+        for product in products:
+            product.find_set_representation()
+            product.cache_similarity_inputs()
 
-        # Set to ensure uniqueness
-        all_componenents = set()
-        for representation in representations:
-            all_componenents.update(representation)
 
-        # List to have a well-defined order
-        all_components_list = list(all_componenents)
+    @staticmethod
+    def minhash(products: list[Item], filter_num: int, do_print = True) -> csr_matrix:
+        return Item.binary_matrix(products, filter_num, do_print)[0]
+
 
-        result = lil_matrix((len(all_components_list), len(products)))
+    @staticmethod
+    @profiled("binary_matrix", lambda result: {"products": result[0].shape[1], "components": result[0].shape[0]})
+    def binary_matrix(products: list[Item], filter_num: int, do_print = True) -> tuple[csr_matrix, list[str]]:
+        # Component x product matrix, together with the component of each row
+        # Rows are in sorted order of the components, such that the result doesn't depend on set ordering
 
-        # Loop over the list to maintain ordering
-        for i, feature in enumerate(all_components_list):
-            for j, representation in enumerate(representations):
-                if feature in representation:
-                    # Can be any value, just have to create the entry
-                    result[i, j] = True
+        # Assign ids to components in order of appearance, recording the (component, product)
+        # index of every occurrence along the way
+        component_ids: dict[str, int] = {}
+        rows: list[int] = []
+        cols: list[int] = []
 
+        for j, product in enumerate(products):
+            for component in product.set_representation:
+                rows.append(component_ids.setdefault(component, len(component_ids)))
+                cols.append(j)
 
-        # Clean up the data, removing components which only appear for a single product
-        # or which occur many times
-        rows, _ = result.nonzero()
+        # Renumber in sorted order
+        all_components_list = sorted(component_ids)
+        sorted_ids = np.empty(len(component_ids), dtype = np.int32)
+        sorted_ids[[component_ids[component] for component in all_components_list]] = np.arange(len(component_ids))
 
-        occurrences = defaultdict(int)
+        rows = sorted_ids[np.array(rows, dtype = np.int32)]
+        cols = np.array(cols, dtype = np.int32)
 
-        for row in rows:
-            occurrences[row] += 1
+        # Can be any value, just have to create the entry
+        result = coo_matrix((np.ones(len(rows), dtype = bool), (rows, cols)),
+                            shape = (len(component_ids), len(products))).tocsr()
 
-        many_occurrences = dict(filter(lambda x: x[1] > filter_num, occurrences.items()))
+        # Clean up the data, removing components which occur many times
+        occurrences = np.bincount(rows, minlength = len(component_ids))
+        keep = occurrences <= filter_num
 
-        all_filtered_features = {**many_occurrences}
+        result = result[keep]
 
-        for row in sorted(list(all_filtered_features.keys()), reverse = True):
-            # https://stackoverflow.com/questions/13077527/is-there-a-numpy-delete-equivalent-for-sparse-matrices
-            result.rows = np.delete(result.rows, row)
-            result.data = np.delete(result.data, row)
-            result._shape = (result._shape[0] - 1, result._shape[1])
+        # Also remove corresponding components from products' set representations
+        if not keep.all():
+            filtered_components = {all_components_list[row] for row in np.flatnonzero(~keep)}
 
-            # Also remove corresponding components from products' set representations
             for product in products:
-                product.set_representation.discard(all_components_list[row])
+                if not product.set_representation.isdisjoint(filtered_components):
+                    # Rebound rather than updated in place, such that copies of a product don't share the change
+                    product.set_representation = product.set_representation - filtered_components
+                    product.cache_similarity_inputs()
 
 
         if do_print:
             print(f"Binary matrix size: {result.shape}")
 
-        return result
+        return result, [component for component, kept in zip(all_components_list, keep) if kept]
 
 
     @staticmethod
-    def binary_to_signatures(binary_data: lil_matrix, num_hashes: int, do_print: bool = True) -> np.ndarray:
-        result = np.full([num_hashes, binary_data.shape[1]], float("inf"))
+    def hash_coefficients(num_hashes: int, rng: np.random.Generator = None) -> np.ndarray:
+        # (a, b) of each hash function, shape (num_hashes, 2)
+        if rng is not None:
+            return rng.integers(0, 100_000, size = (num_hashes, 2), endpoint = True)
 
-        # https://stackoverflow.com/questions/4319014/iterating-through-a-scipy-sparse-vector-or-matrix
-        rows, cols = binary_data.nonzero()
+        # Draw the coefficients in the same order as drawing them per hash function does,
+        # such that a fixed seed of the random module yields the same hash functions
+        return np.array([(randint(0, 100_000), randint(0, 100_000)) for _ in range(num_hashes)], dtype = np.int64)
 
-        for h in range(num_hashes):
-            if do_print:
-                print(f"{h} ({h / num_hashes:.1%})", end = "\r")
 
-            a = randint(0, 100_000)
-            b = randint(0, 100_000)
+    @staticmethod
+    @profiled("signatures", lambda result: {"products": (result[0] if isinstance(result, tuple) else result).shape[1]})
+    def binary_to_signatures(binary_data: spmatrix, num_hashes: int, do_print: bool = True, chunk_size: int = 16,
+                             rng: np.random.Generator = None, with_second: bool = False,
+                             method: str = "minhash") -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        # method is one of SIGNATURE_METHODS:
+        # - minhash: num_hashes hash functions, each evaluated on all components
+        # - oph: one permutation hashing, a single hash function split into num_hashes bins
+        if method not in SIGNATURE_METHODS:
+            raise ValueError(f"Unknown signature method '{method}', expected one of {SIGNATURE_METHODS}")
 
-            for row, col in zip(rows, cols):
-                # nonzero() already filters zero values
-                result[h, col] = min(custom_hash(row, a, b), result[h, col])
+        if method == "oph":
+            if with_second:
+                raise ValueError("Second smallest hash values are only available with minhash")
 
-        return result
+            seed = int(rng.integers(0, 1 << 63)) if rng is not None else randint(0, (1 << 63) - 1)
 
+            return one_permutation_signatures(binary_data, num_hashes, seed, do_print)
 
-class Signature():
-    def __init__(self, signature: np.ndarray):
-        self.value = signature
+        coefficients = Item.hash_coefficients(num_hashes, rng)
 
-    # Hash of each band of the signature
-    def hashes(self, num_bands, num_rows) -> list[int]:
-        result = []
+        return Item.signatures(binary_data, coefficients, do_print, chunk_size, with_second)
 
-        for i in range(num_bands):
-            band = self.value[i * num_rows:(i + 1) * num_rows]
-            result.append(sum([hash(i) for i in band]))
 
-        return result
+    @staticmethod
+    def signatures(binary_data: spmatrix, coefficients: np.ndarray, do_print: bool = True, chunk_size: int = 16,
+                   with_second: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        # Signature of each product (column) under the hash functions given by coefficients
+        # With with_second, also the second smallest hash values, as used for multi-probe LSH
+        num_hashes = len(coefficients)
+
+        # CSC stores the nonzero rows of each product (column) contiguously,
+        # so the minimum per product is a segmented minimum over the column pointers
+        binary_data = csc_matrix(binary_data)
+        rows = binary_data.indices.astype(np.int64)
+
+        # reduceat can't handle empty segments, those products keep the empty value
+        sizes = np.diff(binary_data.indptr)
+        non_empty = sizes > 0
+        starts = binary_data.indptr[:-1][non_empty]
+
+        result = np.full([num_hashes, binary_data.shape[1]], EMPTY_SIGNATURE, dtype = np.uint32)
+        second = np.full_like(result, EMPTY_SIGNATURE) if with_second else None
+
+        # Chunk over hash functions to bound memory to chunk_size * nnz
+        for start in range(0, num_hashes, chunk_size):
+            if do_print:
+                print(f"{start} ({start / num_hashes:.1%})", end = "\r")
 
-    def __str__(self) -> str:
-        return f"Signature: {str(self.value):.40s}..."
+            a = coefficients[start:start + chunk_size, 0, None]
+            b = coefficients[start:start + chunk_size, 1, None]
 
-    def __repr__(self) -> str:
-        return self.__str__()
+            hashes = custom_hash(rows, a, b)
+
+            if len(starts) > 0:
+                minimum = np.minimum.reduceat(hashes, starts, axis = 1)
+                result[start:start + chunk_size, non_empty] = minimum
+
+                if with_second:
+                    # Minimum over the values other than the minimum, empty if there are none
+                    hashes[hashes == np.repeat(minimum, sizes[non_empty], axis = 1)] = EMPTY_SIGNATURE
+                    second[start:start + chunk_size, non_empty] = np.minimum.reduceat(hashes, starts, axis = 1)
 
+        if with_second:
+            return result, second
+
+        return result
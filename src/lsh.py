@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from collections.abc import Iterable, Iterator
+
+from scipy.sparse import csc_matrix
+
+from item import Item
+from pairs import pack_pairs, unpack_pairs
+from profiling import profiled
+from signatures import EMPTY_SIGNATURE, PackedSignatures, mix
+
+
+# Multiplier of the polynomial band hash, the 64 bit FNV prime
+BAND_PRIME = np.uint64(0x100000001B3)
+
+
+def band_hashes(signatures: np.ndarray | PackedSignatures, num_bands: int, num_rows: int) -> np.ndarray:
+    # Polynomial hash over the rows of each band, h = ((x_0 * P + x_1) * P + x_2) ...
+    # Computed for all bands of all products at once, shape (num_bands, num_products)
+    # Row by row, such that packed signatures are only unpacked num_bands rows at a time
+    first_rows = np.arange(num_bands) * num_rows
+
+    result = np.zeros([num_bands, signatures.shape[1]], dtype = np.uint64)
+
+    for row in range(num_rows):
+        result *= BAND_PRIME
+        result += mix(signatures[first_rows + row])
+
+    return result
+
+
+def probe_hashes(signatures: np.ndarray, second_signatures: np.ndarray, num_bands: int, num_rows: int,
+                 num_probes: int) -> tuple[np.ndarray, np.ndarray]:
+    # Band hashes of the buckets next to those of each product, shape (num_probes, num_bands, num_products)
+    # Probe t of a band replaces the row with the t-th smallest gap between the minimum and second smallest
+    # hash value by its second smallest value. A small gap means a small change to the component set could
+    # make the second smallest the minimum, so those rows are the least confident ones.
+    # Also returns which probes exist, rows without a second smallest value can't be perturbed
+    num_products = signatures.shape[1]
+    num_probes = min(num_probes, num_rows)
+
+    bands = signatures[:num_bands * num_rows].reshape(num_bands, num_rows, -1)
+    second = second_signatures[:num_bands * num_rows].reshape(num_bands, num_rows, -1)
+
+    gaps = np.where(second == EMPTY_SIGNATURE, np.iinfo(np.int64).max, second.astype(np.int64) - bands)
+    rows = np.argsort(gaps, axis = 1, kind = "stable")[:, :num_probes]
+
+    # Weight of each row in the polynomial band hash, P^(num_rows - 1 - row)
+    # Array arithmetic, as numpy warns about scalars wrapping around
+    weights = np.ones(num_rows, dtype = np.uint64)
+    for power in range(1, num_rows):
+        weights[:num_rows - power] *= BAND_PRIME
+
+    hashes = band_hashes(signatures, num_bands, num_rows)
+
+    result = np.empty([num_probes, num_bands, num_products], dtype = np.uint64)
+    valid = np.empty([num_probes, num_bands, num_products], dtype = bool)
+
+    for probe in range(num_probes):
+        row = rows[:, probe]
+        original = np.take_along_axis(bands, row[:, None], axis = 1)[:, 0]
+        perturbed = np.take_along_axis(second, row[:, None], axis = 1)[:, 0]
+
+        # Replace the row within the polynomial hash, wrapping around like the hash itself
+        result[probe] = hashes + (mix(perturbed) - mix(original)) * weights[row]
+        valid[probe] = perturbed != EMPTY_SIGNATURE
+
+    return result, valid
+
+
+def coarsen_band_hashes(hashes: np.ndarray, num_rows: int, factor: int) -> np.ndarray:
+    # Band hashes of factor times as many rows per band, from the band hashes of num_rows rows
+    # The polynomial hash composes as h(A || B) = h(A) * P^len(B) + h(B), so every
+    # factor consecutive bands are combined without looking at the signatures again
+    num_bands = hashes.shape[0] // factor
+    multiplier = BAND_PRIME ** np.uint64(num_rows)
+
+    result = np.zeros([num_bands, hashes.shape[1]], dtype = np.uint64)
+    bands = hashes[:num_bands * factor].reshape(num_bands, factor, -1)
+
+    for band in range(factor):
+        result *= multiplier
+        result += bands[:, band]
+
+    return result
+
+
+def estimated_jaccard(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    # Fraction of signature rows (axis 0) on which first and second agree, the MinHash estimate of their Jaccard similarity
+    # Rows of products without components don't count as agreeing
+    return ((first == second) & (first != EMPTY_SIGNATURE)).mean(axis = 0)
+
+
+def pair_similarity(signatures: np.ndarray | PackedSignatures, pairs: np.ndarray, chunk_size: int = 1 << 14) -> np.ndarray:
+    # Estimated Jaccard similarity of each (i, j) pair, in chunks of chunk_size pairs to bound memory
+    result = np.empty(len(pairs))
+
+    for start in range(0, len(pairs), chunk_size):
+        chunk = pairs[start:start + chunk_size]
+
+        if isinstance(signatures, PackedSignatures):
+            result[start:start + chunk_size] = signatures.estimated_jaccard(chunk[:, 0], chunk[:, 1])
+        else:
+            result[start:start + chunk_size] = estimated_jaccard(signatures[:, chunk[:, 0]], signatures[:, chunk[:, 1]])
+
+    return result
+
+
+def top_k_pairs(pairs: np.ndarray, similarity: np.ndarray, num_products: int, k: int = None,
+                min_similarity: float = 0) -> tuple[np.ndarray, np.ndarray]:
+    # Pairs with similarity of at least min_similarity that are among the k most similar pairs
+    # of either of their products, sorted by decreasing similarity, together with their similarity
+    order = np.argsort(-similarity, kind = "stable")
+    order = order[similarity[order] >= min_similarity]
+
+    if k is not None:
+        # Rank of each pair among the pairs of each of its products, in order of decreasing similarity
+        # Both products of each pair, in order of decreasing similarity
+        products = pairs[order].ravel()
+        by_product = np.argsort(products, kind = "stable")
+
+        sizes = np.bincount(products, minlength = num_products)
+        starts = np.cumsum(sizes) - sizes
+
+        rank = np.empty(len(products), dtype = np.int64)
+        rank[by_product] = np.arange(len(products)) - np.repeat(starts, sizes)
+
+        order = order[(rank.reshape(-1, 2) < k).any(axis = 1)]
+
+    return pairs[order], similarity[order]
+
+
+def group_ids(keys: np.ndarray) -> np.ndarray:
+    # Label equal keys with the same consecutive integer
+    return np.unique(keys, return_inverse = True)[1].ravel().astype(np.int32)
+
+
+def expand_ranges(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    # Concatenation of arange(start, start + size) for all (start, size)
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+    return np.repeat(starts, sizes) + offsets
+
+
+def unique_sorted(keys: np.ndarray) -> np.ndarray:
+    # Sorting and dropping repeats is much faster than np.unique for large integer arrays
+    keys = np.sort(keys)
+
+    return keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) > 0 else keys
+
+
+class LSHIndex():
+    """
+    Banded LSH over the columns (products) of a signature matrix.
+    Buckets are keyed per band, so products only become candidates
+    if they agree on all rows of the same band.
+    """
+
+    # Ways to deal with buckets larger than max_bucket_size
+    OVERSIZED_POLICIES = ("skip", "sample", "split")
+
+    def __init__(self, signatures: np.ndarray | PackedSignatures, num_bands: int, num_rows: int):
+        if num_bands * num_rows > signatures.shape[0]:
+            raise ValueError(f"{num_bands} bands of {num_rows} rows don't fit in {signatures.shape[0]} hashes")
+
+        self._set_band_hashes(band_hashes(signatures, num_bands, num_rows), num_rows)
+
+    def _set_band_hashes(self, hashes: np.ndarray, num_rows: int) -> None:
+        self.num_bands = hashes.shape[0]
+        self.num_rows = num_rows
+        self.num_products = hashes.shape[1]
+
+        self.band_hashes = hashes
+
+        # Number of pairs in the buckets of each band, before deduplicating across bands
+        # Set by iter_candidate_pairs
+        self.pairs_per_band: np.ndarray = None
+
+    def __str__(self) -> str:
+        return f"LSHIndex: {self.num_products} products, {self.num_bands} bands of {self.num_rows} rows"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @staticmethod
+    def from_band_hashes(hashes: np.ndarray, num_rows: int) -> LSHIndex:
+        # Index on precomputed band hashes of shape (num_bands, num_products)
+        index = LSHIndex.__new__(LSHIndex)
+        index._set_band_hashes(hashes, num_rows)
+
+        return index
+
+    def coarsen(self, factor: int) -> LSHIndex:
+        # Index with factor times as many rows per band, on the same signatures
+        # Identical to LSHIndex(signatures, self.num_bands // factor, self.num_rows * factor)
+        if factor < 1 or self.num_bands < factor:
+            raise ValueError(f"Can't combine {self.num_bands} bands into bands of {factor}")
+
+        return LSHIndex.from_band_hashes(coarsen_band_hashes(self.band_hashes, self.num_rows, factor), self.num_rows * factor)
+
+    def buckets(self, max_bucket_size: int = None, oversized: str = "skip", rng: np.random.Generator = None) -> np.ndarray:
+        # Bucket id of each product in each band, shape (num_bands, num_products)
+        # Buckets with more than max_bucket_size products are broken up according to the oversized policy:
+        # - skip: all products in the bucket become singletons
+        # - sample: a random max_bucket_size products remain, the others become singletons
+        # - split: the bucket is split on the hash of the next band, remaining oversized parts are sampled
+        if rng is None:
+            rng = np.random.default_rng()
+
+        result = np.empty([self.num_bands, self.num_products], dtype = np.int32)
+
+        for band in range(self.num_bands):
+            result[band] = self._band_buckets(band, max_bucket_size, oversized, rng)
+
+        return result
+
+    def _band_buckets(self, band: int, max_bucket_size: int, oversized: str, rng: np.random.Generator) -> np.ndarray:
+        # Bucket id of each product in one band, see buckets
+        if oversized not in self.OVERSIZED_POLICIES:
+            raise ValueError(f"Unknown policy for oversized buckets '{oversized}', expected one of {self.OVERSIZED_POLICIES}")
+
+        ids = group_ids(self.band_hashes[band])
+
+        if max_bucket_size is not None:
+            if oversized == "split":
+                ids = self._split_oversized(ids, band, max_bucket_size)
+
+            ids = self._break_oversized(ids, max_bucket_size, keep = 0 if oversized == "skip" else max_bucket_size, rng = rng)
+
+        return ids
+
+    def _split_oversized(self, ids: np.ndarray, band: int, max_bucket_size: int) -> np.ndarray:
+        sizes = np.bincount(ids)
+        in_oversized = sizes[ids] > max_bucket_size
+
+        if not in_oversized.any() or self.num_bands == 1:
+            return ids
+
+        # Secondary key is the hash of the next band, combined such that it stays within the bucket
+        secondary = self.band_hashes[(band + 1) % self.num_bands, in_oversized]
+        combined = np.stack([ids[in_oversized].astype(np.uint64), secondary], axis = 1)
+
+        ids = ids.copy()
+        ids[in_oversized] = len(sizes) + np.unique(combined, axis = 0, return_inverse = True)[1].ravel()
+
+        return ids
+
+    @staticmethod
+    def _break_oversized(ids: np.ndarray, max_bucket_size: int, keep: int, rng: np.random.Generator) -> np.ndarray:
+        sizes = np.bincount(ids)
+        oversized = np.flatnonzero(sizes > max_bucket_size)
+
+        if len(oversized) == 0:
+            return ids
+
+        ids = ids.copy()
+        next_id = len(sizes)
+
+        for bucket in oversized:
+            members = np.flatnonzero(ids == bucket)
+            removed = members if keep == 0 else rng.permutation(members)[keep:]
+
+            ids[removed] = np.arange(next_id, next_id + len(removed))
+            next_id += len(removed)
+
+        return ids
+
+    def iter_candidate_pairs(self, chunk_size: int = 1 << 22, max_bucket_size: int = None, oversized: str = "skip",
+                             rng: np.random.Generator = None) -> Iterator[np.ndarray]:
+        # Unique (i, j), i < j, pairs of products sharing a bucket in any band, in chunks
+        # Products are processed in consecutive ranges, such that all occurrences of a pair (i, j) are
+        # generated while processing the range containing i. Deduplication across bands then only needs
+        # that chunk, which keeps memory bounded by chunk_size pair occurrences rather than the total
+        # Only products in buckets of more than one product are kept between bands, as no other
+        # bucket gives any pairs, such that memory grows with those rather than num_bands * num_products
+        if rng is None:
+            rng = np.random.default_rng()
+
+        # Products of all shared buckets of all bands, grouped by bucket, and for each of these entries
+        # the start of its bucket among them and the size of its bucket
+        members: list[np.ndarray] = [np.empty(0, dtype = np.int32)]
+        starts: list[np.ndarray] = [np.empty(0, dtype = np.int64)]
+        sizes: list[np.ndarray] = [np.empty(0, dtype = np.int32)]
+        offset = 0
+
+        self.pairs_per_band = np.zeros(self.num_bands, dtype = np.int64)
+
+        for band in range(self.num_bands):
+            ids = self._band_buckets(band, max_bucket_size, oversized, rng)
+
+            shared = np.flatnonzero(np.bincount(ids)[ids] > 1).astype(np.int32)
+            shared = shared[np.argsort(ids[shared], kind = "stable")]
+
+            # Runs of equal buckets
+            sorted_ids = ids[shared]
+            run_starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(shared) > 0 else np.empty(0, dtype = np.int64)
+            run_sizes = np.diff(np.r_[run_starts, len(shared)]).astype(np.int32)
+
+            self.pairs_per_band[band] = (run_sizes.astype(np.int64) * (run_sizes - 1)).sum() // 2
+
+            members.append(shared)
+            starts.append(offset + np.repeat(run_starts, run_sizes))
+            sizes.append(np.repeat(run_sizes, run_sizes))
+            offset += len(shared)
+
+        members = np.concatenate(members)
+
+        # The entries again, grouped by product instead
+        # Not stable, as the order of the pairs within a chunk doesn't matter
+        by_product = np.argsort(members)
+        products = members[by_product]
+        starts = np.concatenate(starts)[by_product]
+        sizes = np.concatenate(sizes)[by_product]
+        del by_product
+
+        # Split the products into ranges of at most chunk_size pair occurrences
+        # A single product with more occurrences gets a range of its own
+        occurrences = np.cumsum(np.bincount(products, weights = sizes, minlength = self.num_products).astype(np.int64))
+        boundaries = np.unique(np.searchsorted(occurrences, np.arange(chunk_size, occurrences[-1] if len(occurrences) else 0, chunk_size), side = "right"))
+        boundaries = np.r_[0, boundaries[(boundaries > 0) & (boundaries < self.num_products)], self.num_products]
+
+        for low, high in zip(boundaries[:-1], boundaries[1:]):
+            first_entry, last_entry = np.searchsorted(products, [low, high])
+
+            first = np.repeat(products[first_entry:last_entry].astype(np.int64), sizes[first_entry:last_entry])
+            second = members[expand_ranges(starts[first_entry:last_entry], sizes[first_entry:last_entry])]
+
+            keep = first < second
+            keys = unique_sorted(first[keep] * self.num_products + second[keep])
+
+            if len(keys) > 0:
+                yield unpack_pairs(keys, self.num_products)
+
+    @profiled("LSH", lambda result: {"pairs": len(result)})
+    def candidate_pairs(self, **kwargs) -> np.ndarray:
+        # All unique (i, j), i < j, pairs of products sharing a bucket in any band, shape (num_pairs, 2)
+        # Chunks are ordered, so this is sorted as well
+        return np.concatenate([np.empty((0, 2), dtype = np.int32), *self.iter_candidate_pairs(**kwargs)])
+
+    @profiled("multi-probe LSH", lambda result: {"pairs": len(result)})
+    def multi_probe_pairs(self, signatures: np.ndarray, second_signatures: np.ndarray, num_probes: int = 1) -> np.ndarray:
+        # candidate_pairs plus the pairs of which one product's bucket is among the num_probes
+        # buckets next to the other's in the same band, see probe_hashes. Sorted as well
+        probes, valid = probe_hashes(signatures, second_signatures, self.num_bands, self.num_rows, num_probes)
+
+        keys = [pack_pairs(self.candidate_pairs(), self.num_products)]
+
+        for band in range(self.num_bands):
+            # Products sorted by bucket, the products in a probed bucket are a range of those
+            order = np.argsort(self.band_hashes[band], kind = "stable")
+            sorted_hashes = self.band_hashes[band][order]
+
+            for probe in range(len(probes)):
+                low = np.searchsorted(sorted_hashes, probes[probe, band], side = "left")
+                sizes = np.searchsorted(sorted_hashes, probes[probe, band], side = "right") - low
+                sizes[~valid[probe, band]] = 0
+
+                first = np.repeat(np.arange(self.num_products), sizes)
+                second = order[expand_ranges(low, sizes)]
+
+                different = first != second
+                first, second = first[different], second[different]
+
+                keys.append(np.minimum(first, second) * self.num_products + np.maximum(first, second))
+
+        return unpack_pairs(unique_sorted(np.concatenate(keys)), self.num_products)
+
+
+class DedupIndex():
+    """
+    Persistent LSH index to which products can be added and removed one batch at a time.
+    The component vocabulary and the hash functions are frozen when the index is built,
+    components that aren't in the vocabulary are ignored for products added later.
+    So are the weight and diagonal quantile boundaries and the brands of the catalogue, against which
+    products that are added or queried are preprocessed (see prepare), such that they get the
+    same set representation as they would have had as part of the catalogue.
+    Products are identified by ids handed out by add, buckets are kept per band as
+    dicts from band hash to ids, so adding, removing and querying a product only
+    touches the buckets of its own bands.
+    """
+
+    def __init__(self, vocabulary: list[str], coefficients: np.ndarray, num_bands: int, num_rows: int,
+                 weight_quantiles: np.ndarray, diagonal_quantiles: np.ndarray, brands: list[str]):
+        if num_bands * num_rows > len(coefficients):
+            raise ValueError(f"{num_bands} bands of {num_rows} rows don't fit in {len(coefficients)} hashes")
+
+        self.vocabulary = vocabulary
+        self.component_ids = {component: i for i, component in enumerate(vocabulary)}
+        self.coefficients = coefficients
+        self.num_bands = num_bands
+        self.num_rows = num_rows
+
+        # Preprocessing state of the catalogue, see Item.prepare
+        self.weight_quantiles = weight_quantiles
+        self.diagonal_quantiles = diagonal_quantiles
+        self.brands = brands
+
+        # Per band, band hash -> ids of the products in that bucket
+        self.tables: list[dict[int, set[int]]] = [{} for _ in range(num_bands)]
+
+        # id -> signature of that product, for ranking and removal
+        self.product_signatures: dict[int, np.ndarray] = {}
+        self.next_id = 0
+
+    def __len__(self) -> int:
+        return len(self.product_signatures)
+
+    def __str__(self) -> str:
+        return f"DedupIndex: {len(self)} products, {len(self.vocabulary)} components, {self.num_bands} bands of {self.num_rows} rows"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @staticmethod
+    def build(products: list[Item], num_hashes: int, num_bands: int, num_rows: int, filter_num: int = 500,
+              rng: np.random.Generator = None, do_print: bool = True) -> DedupIndex:
+        # Index on a catalogue, with the vocabulary of its components and new hash functions
+        # The products have to be preprocessed together, as load_data does, their quantiles and brands are frozen
+        # Products get ids 0 .. len(products) - 1
+        weight_quantiles, diagonal_quantiles = Item.quantile_boundaries(products)
+        brands = Item.known_brands(products)
+
+        binary_data, vocabulary = Item.binary_matrix(products, filter_num, do_print)
+        coefficients = Item.hash_coefficients(num_hashes, rng)
+
+        index = DedupIndex(vocabulary, coefficients, num_bands, num_rows, weight_quantiles, diagonal_quantiles, brands)
+        index._insert(np.arange(len(products)), Item.signatures(binary_data, coefficients, do_print))
+        index.next_id = len(products)
+
+        return index
+
+    def prepare(self, items: list[Item]) -> None:
+        # Preprocesses new items against the frozen state of the catalogue, instead of against each other
+        Item.prepare(items, self.weight_quantiles, self.diagonal_quantiles, self.brands)
+
+    def binary_matrix(self, items: list[Item]) -> csc_matrix:
+        # Component x product matrix of items in the frozen vocabulary
+        rows: list[int] = []
+        indptr = [0]
+
+        for item in items:
+            rows.extend(sorted(self.component_ids[component] for component in item.set_representation if component in self.component_ids))
+            indptr.append(len(rows))
+
+        return csc_matrix((np.ones(len(rows), dtype = bool), np.array(rows, dtype = np.int32), np.array(indptr)),
+                          shape = (len(self.vocabulary), len(items)))
+
+    def signatures(self, items: list[Item]) -> np.ndarray:
+        # Shape (num_hashes, len(items))
+        return Item.signatures(self.binary_matrix(items), self.coefficients, do_print = False)
+
+    def _insert(self, ids: np.ndarray, signatures: np.ndarray) -> None:
+        hashes = band_hashes(signatures, self.num_bands, self.num_rows)
+
+        for band, table in enumerate(self.tables):
+            for id, key in zip(ids.tolist(), hashes[band].tolist()):
+                table.setdefault(key, set()).add(id)
+
+        for id, column in zip(ids.tolist(), signatures.T):
+            self.product_signatures[id] = column
+
+    def add(self, items: list[Item]) -> np.ndarray:
+        # Ids given to the items, which are preprocessed first
+        self.prepare(items)
+
+        ids = np.arange(self.next_id, self.next_id + len(items))
+        self.next_id += len(items)
+
+        self._insert(ids, self.signatures(items))
+
+        return ids
+
+    def remove(self, ids: Iterable[int]) -> None:
+        for id in ids:
+            signature = self.product_signatures.pop(id)
+            hashes = band_hashes(signature[:, None], self.num_bands, self.num_rows)[:, 0]
+
+            for table, key in zip(self.tables, hashes.tolist()):
+                bucket = table[key]
+                bucket.discard(id)
+
+                if not bucket:
+                    del table[key]
+
+    def query(self, item: Item) -> set[int]:
+        # Ids of the products sharing a bucket with item in any band, item is preprocessed first
+        self.prepare([item])
+
+        return self.query_hashes(band_hashes(self.signatures([item]), self.num_bands, self.num_rows)[:, 0])
+
+    def query_hashes(self, hashes: np.ndarray) -> set[int]:
+        result: set[int] = set()
+
+        for table, key in zip(self.tables, hashes.tolist()):
+            result.update(table.get(key, ()))
+
+        return result
+
+    def query_top_k(self, items: list[Item], k: int = 10, min_similarity: float = 0) -> list[list[tuple[int, float]]]:
+        # Per item, the (id, estimated Jaccard similarity) of at most k candidates with a similarity
+        # of at least min_similarity, most similar first. The items are preprocessed first
+        self.prepare(items)
+
+        signatures = self.signatures(items)
+        hashes = band_hashes(signatures, self.num_bands, self.num_rows)
+
+        result = []
+        for column in range(len(items)):
+            candidates = np.fromiter(self.query_hashes(hashes[:, column]), dtype = np.int64)
+
+            if len(candidates) == 0:
+                result.append([])
+                continue
+
+            candidate_signatures = np.stack([self.product_signatures[id] for id in candidates.tolist()], axis = 1)
+            similarity = estimated_jaccard(candidate_signatures, signatures[:, column, None])
+
+            order = np.argsort(-similarity, kind = "stable")[:k]
+            order = order[similarity[order] >= min_similarity]
+
+            result.append(list(zip(candidates[order].tolist(), similarity[order].tolist())))
+
+        return result
+
+    @staticmethod
+    def _filename(filename: str) -> str:
+        # np.savez adds .npz if it's missing, so load has to look for the same name
+        return filename if filename.endswith(".npz") else filename + ".npz"
+
+    def save(self, filename: str) -> None:
+        ids = np.fromiter(self.product_signatures, dtype = np.int64, count = len(self))
+        signatures = np.array(list(self.product_signatures.values()), dtype = np.uint32).reshape(len(self), -1).T
+
+        np.savez(self._filename(filename), vocabulary = np.array(self.vocabulary, dtype = str), coefficients = self.coefficients,
+                 shape = np.array([self.num_bands, self.num_rows, self.next_id]), ids = ids, signatures = signatures,
+                 weight_quantiles = self.weight_quantiles, diagonal_quantiles = self.diagonal_quantiles,
+                 brands = np.array(self.brands, dtype = str))
+
+    @staticmethod
+    def load(filename: str) -> DedupIndex:
+        with np.load(DedupIndex._filename(filename)) as data:
+            num_bands, num_rows, next_id = data["shape"].tolist()
+
+            index = DedupIndex(data["vocabulary"].tolist(), data["coefficients"], num_bands, num_rows,
+                               data["weight_quantiles"], data["diagonal_quantiles"], data["brands"].tolist())
+            # Bucket tables are rebuilt from the signatures, keeping the saved ids
+            index._insert(data["ids"], data["signatures"])
+
+        index.next_id = next_id
+
+        return index
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import re
+
+from collections.abc import Iterable
+from functools import lru_cache
+from sys import intern
+
+
+# Rewrites all inch and hertz notations to "inch" and "hz" in a single pass
+# Equivalent to successively replacing ['"', " inch", "-inch", "inches", "Inch", "-Inch", " Inch"] by "inch"
+# and then ["hertz", "hz", " hz", "Hertz", "Hz", "Hz"] by "hz", followed by lowercasing.
+# The prefixes and suffixes cover the replacements that earlier replacements enable,
+# e.g. ' "es' -> ' inches' -> 'inches' -> 'inch' and '"ertz' -> 'inchertz' -> 'inchz'.
+# "Inch" and "Hz" only change case. The lookahead lets most positions fail on a single character
+INCH_HZ = re.compile(r'(?=[- "ihH])(?:(?P<inch>(?:- |[ -])?(?:"|inch)(?:es)?)(?P<ertz>ertz)?|(?P<hz> ?hertz| hz|Hertz))')
+
+# Matches 1.2, 1., 1 and .2
+NUMBER = re.compile(r"\.?\d+\.?\d*")
+
+REFRESH_RATE = re.compile(r"\d+\s?[Hh][Zz]")
+
+# Non-capturing, such that findall returns the whole matches
+TITLE_COMPONENT = re.compile(r"[a-zA-Z0-9]*(?:(?:[0-9]+[^0-9, ]+)|(?:[^0-9, ]+[0-9]+))[a-zA-Z0-9]*")
+# Applied to all feature values of a product joined by SEPARATOR, where ^ of the
+# per-value regex becomes the start of the string or a preceding separator
+VALUE_COMPONENT = re.compile(r"\d+(?:\.\d+)?[a-zA-Z]+|(?:^|(?<=\x00))\d+(?:\.\d+)?")
+
+# Joins feature values such that they can be processed with one regex call per product
+# None of the patterns above can match across it
+SEPARATOR = "\x00"
+
+
+def _unit(match: re.Match) -> str:
+    if match.group("hz"):
+        return "hz"
+
+    return "inchz" if match.group("ertz") else "inch"
+
+
+def normalize(string: str) -> str:
+    return INCH_HZ.sub(_unit, string).lower().strip()
+
+
+# Feature names repeat across products, so remember them
+@lru_cache(maxsize = None)
+def normalize_key(key: str) -> str:
+    return intern(key.lower().replace(":", ""))
+
+
+def parse_numbers(string: str) -> list[float]:
+    # Will have some false positives but I don't get how python re
+    # works with groups so ykno it's fine
+    return [float(i) for i in NUMBER.findall(string)]
+
+
+def find_components(regex: re.Pattern, string: str) -> set[str]:
+    # Interned, as the same components occur in many products
+    return {intern(match.strip()) for match in regex.findall(string)}
+
+
+class NormalizedProduct():
+    """
+    Normalised title and features of a product, together with everything
+    extracted from them while normalising
+    """
+
+    __slots__ = ("model_id", "shop", "title", "features", "refresh_rate", "components")
+
+    def __init__(self, model_id: str, features: dict[str, str], shop: str, title: str):
+        self.model_id = intern(model_id)
+        self.shop = intern(shop.lower())
+        self.title = normalize(title)
+
+        # Normalise all feature values in one go
+        if features:
+            values = normalize(SEPARATOR.join(features.values())).split(SEPARATOR)
+        else:
+            values = []
+
+        self.features: dict[str, str] = {normalize_key(key): val.strip() for key, val in zip(features, values)}
+
+        # Extract everything from the normalised values at once as well
+        values = SEPARATOR.join(self.features.values())
+
+        self.components = find_components(TITLE_COMPONENT, self.title) | find_components(VALUE_COMPONENT, values)
+
+        # The refresh rate is taken from the first value mentioning one
+        # Min should be fine, since we're only comparing quantiles
+        match = REFRESH_RATE.search(values)
+
+        if match:
+            start = values.rfind(SEPARATOR, 0, match.start()) + 1
+            end = values.find(SEPARATOR, match.end())
+
+            self.refresh_rate = min(parse_numbers(values[start:end if end != -1 else len(values)]))
+
+        else:
+            self.refresh_rate = None
+
+    def __str__(self) -> str:
+        return f"NormalizedProduct: '{self.model_id}' ('{self.shop}')"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def normalize_products(records: Iterable[dict]) -> list[NormalizedProduct]:
+    # Normalises raw products as they occur in the data file
+    return [NormalizedProduct(record["modelID"], record["featuresMap"], record["shop"], record["title"]) for record in records]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from collections.abc import Iterable
+
+from item import Item
+
+# Pairs of products are stored as (num_pairs, 2) int32 arrays of indices into the products list,
+# canonically ordered such that pairs[:, 0] < pairs[:, 1]. For set operations they are packed
+# into int64 keys i * num_products + j, which preserve that ordering.
+
+
+def canonical_pairs(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    # Orient as (i < j), drop pairs of a product with itself and repeated pairs
+    first = np.asarray(first, dtype = np.int64)
+    second = np.asarray(second, dtype = np.int64)
+
+    pairs = np.stack([np.minimum(first, second), np.maximum(first, second)], axis = 1)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+
+    return np.unique(pairs, axis = 0).astype(np.int32)
+
+
+def pack_pairs(pairs: np.ndarray, num_products: int) -> np.ndarray:
+    return pairs[:, 0].astype(np.int64) * num_products + pairs[:, 1]
+
+
+def unpack_pairs(keys: np.ndarray, num_products: int) -> np.ndarray:
+    return np.stack([keys // num_products, keys % num_products], axis = 1).astype(np.int32)
+
+
+def value_ids(values: Iterable) -> np.ndarray:
+    # Id of each value, in order of first appearance, such that pairs can compare values by id
+    ids: dict = {}
+
+    return np.array([ids.setdefault(value, len(ids)) for value in values], dtype = np.int32)
+
+
+def shop_ids(products: list[Item]) -> np.ndarray:
+    return value_ids(product.shop for product in products)
+
+
+def pair_labels(pairs: np.ndarray, true_pairs: np.ndarray, num_products: int) -> np.ndarray:
+    # Whether each pair is in true_pairs
+    return np.isin(pack_pairs(pairs, num_products), pack_pairs(true_pairs, num_products))
+
+
+def count_common(pairs: np.ndarray, other_pairs: np.ndarray, num_products: int) -> int:
+    return len(np.intersect1d(pack_pairs(pairs, num_products), pack_pairs(other_pairs, num_products), assume_unique = True))
+
+
+def subset_pairs(pairs: np.ndarray, indices: np.ndarray, num_products: int) -> np.ndarray:
+    # Pairs of which both products are in indices, re-indexed to positions in indices
+    # Only touches the pairs themselves, not all pairs of products in indices
+    position = np.full(num_products, -1, dtype = np.int64)
+    position[indices] = np.arange(len(indices))
+
+    first, second = position[pairs[:, 0]], position[pairs[:, 1]]
+    both = (first >= 0) & (second >= 0)
+
+    # For canonical pairs, increasing indices keep them canonical, without sorting them again
+    if len(indices) < 2 or np.all(indices[1:] > indices[:-1]):
+        return np.stack([first[both], second[both]], axis = 1).astype(np.int32)
+
+    return canonical_pairs(first[both], second[both])
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import cProfile
+import os
+import time
+import tracemalloc
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import wraps
+
+
+class StageRecord():
+    """
+    Totals of all runs of one stage: number of calls, wall and CPU time in seconds,
+    the peak of traced memory above the memory in use at the start, in bytes,
+    and counts such as the number of products or pairs handled
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_memory = 0
+        self.counts: dict[str, int] = {}
+
+    def __str__(self) -> str:
+        counts = ", ".join(f"{name} {count}" for name, count in self.counts.items())
+        return f"{self.calls} calls, {self.wall:.3f} s wall, {self.cpu:.3f} s CPU, {self.peak_memory / 1e6:.1f} MB peak" + (f", {counts}" if counts else "")
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def count(self, **counts: int) -> None:
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + int(count)
+
+    def merge(self, other: StageRecord) -> None:
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.peak_memory = max(self.peak_memory, other.peak_memory)
+        self.count(**other.counts)
+
+    def to_dict(self) -> dict:
+        return {"calls": self.calls, "wall": self.wall, "cpu": self.cpu, "peak_memory": self.peak_memory, "counts": self.counts}
+
+    @staticmethod
+    def from_dict(data: dict) -> StageRecord:
+        record = StageRecord()
+        record.calls, record.wall, record.cpu, record.peak_memory = data["calls"], data["wall"], data["cpu"], data["peak_memory"]
+        record.counts = dict(data["counts"])
+
+        return record
+
+
+class Profiler():
+    """
+    Collects a StageRecord per stage while active (with profiler: ...).
+    Stages nest, a stage is recorded under the names of the stages around it joined by "/".
+    With memory, tracemalloc is running while active, which slows down allocation heavy code.
+    With profile_directory, every outermost stage also runs under cProfile and its statistics are
+    dumped to a .prof file in that directory.
+    """
+
+    def __init__(self, memory: bool = False, profile_directory: str = None):
+        self.memory = memory
+        self.profile_directory = profile_directory
+
+        self.records: dict[str, StageRecord] = {}
+
+        # Names and peak memory so far of the stages that are running
+        self._stack: list[str] = []
+        self._peaks: list[int] = []
+        self._started_tracing = False
+        self._num_profiles = 0
+
+        # Profiler that was active before this one
+        self._previous: Profiler = None
+
+    def __str__(self) -> str:
+        return "\n".join(f"{name}: {record}" for name, record in self.records.items())
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __enter__(self) -> Profiler:
+        global _active
+        self._previous, _active = _active, self
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        return self
+
+    def __exit__(self, *exception) -> None:
+        global _active
+        _active = self._previous
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _update_peaks(self) -> None:
+        # Before the peak is reset for a nested stage, the stages around it take the peak so far
+        current, peak = tracemalloc.get_traced_memory()
+        self._peaks = [max(start, peak) for start in self._peaks]
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageRecord]:
+        # Yields a record of this run, to which counts can be added
+        path = "/".join(self._stack + [name])
+        record = StageRecord()
+
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            self._update_peaks()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            self._peaks.append(start_memory)
+
+        profile = None
+        if self.profile_directory is not None and not self._stack:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        self._stack.append(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield record
+
+        finally:
+            record.wall = time.perf_counter() - wall
+            record.cpu = time.process_time() - cpu
+            record.calls = 1
+
+            self._stack.pop()
+
+            if profile is not None:
+                profile.disable()
+
+                os.makedirs(self.profile_directory, exist_ok = True)
+                profile.dump_stats(os.path.join(self.profile_directory, f"{self._num_profiles:04d} {name}.prof"))
+                self._num_profiles += 1
+
+            if tracing:
+                self._update_peaks()
+                record.peak_memory = self._peaks.pop() - start_memory
+
+            self.records.setdefault(path, StageRecord()).merge(record)
+
+    def merge(self, other: Profiler | dict) -> None:
+        # Adds the records of another profiler, or of its to_dict, such as from another process
+        records = other.records if isinstance(other, Profiler) else {name: StageRecord.from_dict(data) for name, data in other.items()}
+
+        for name, record in records.items():
+            self.records.setdefault(name, StageRecord()).merge(record)
+
+    def to_dict(self) -> dict:
+        return {name: record.to_dict() for name, record in self.records.items()}
+
+    def totals(self) -> Profiler:
+        # Records merged by the name of the stage itself, regardless of the stages around it,
+        # such as the LSH stage over all num_rows of a sweep
+        totals = Profiler()
+
+        for path, record in self.records.items():
+            totals.records.setdefault(path.rsplit("/", 1)[-1], StageRecord()).merge(record)
+
+        return totals
+
+
+# The profiler stages are recorded in, if any
+_active: Profiler = None
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageRecord]:
+    # Records a stage in the active profiler, without one the record is thrown away
+    if _active is None:
+        yield StageRecord()
+        return
+
+    with _active.stage(name) as record:
+        yield record
+
+
+def profiled(name: str, counts: Callable[..., dict[str, int]] = None) -> Callable:
+    # Decorator recording every call of a function as a stage
+    # counts is given the result of the function and returns the counts to record
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                result = function(*args, **kwargs)
+
+                if counts is not None and _active is not None:
+                    record.count(**counts(result))
+
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import random
+import numpy as np
+
+from itertools import combinations
+
+from scipy.sparse import spmatrix
+
+from ingest import read_json
+from item import Item, custom_hash
+from lsh import LSHIndex
+from normalize import SEPARATOR, normalize
+from signatures import EMPTY_SIGNATURE
+from sweep import nested_indices
+
+
+# Straightforward versions of code that has since been optimised, and checks that the
+# optimised code still gives exactly the same results. Run as a script to check all of them
+# on the TV data and on random inputs, any difference raises an AssertionError.
+
+
+# Pieces of the random strings for check_normalize, around and inside the inch and hertz notations
+NORMALIZE_PIECES = ('"', " ", "-", "inch", "Inch", "es", "hertz", "Hertz", "hz", "Hz", "ertz", "h", "H", "i", "z", "1", "a", SEPARATOR)
+
+
+def replace_all(string: str, keys: list[str], to: str) -> str:
+    for key in keys:
+        string = string.replace(key, to)
+
+    return string
+
+
+def reference_normalize(string: str) -> str:
+    # normalize as the chains of replacements it replaced
+    return replace_all(
+        replace_all(string, ['"', " inch", "-inch", "inches", "Inch", "-Inch", " Inch"], "inch"),
+        ["hertz", "hz", " hz", "Hertz", "Hz", "Hz"], "hz").lower().strip()
+
+
+def check_normalize(strings: list[str], num_random: int = 200_000, rng: np.random.Generator = None) -> None:
+    # normalize equals the replacements on strings and on num_random random strings, and values joined
+    # by SEPARATOR are normalised the same as one at a time, as NormalizedProduct does
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    lengths = rng.integers(0, 12, size = num_random)
+    pieces = rng.integers(0, len(NORMALIZE_PIECES), size = lengths.sum()).tolist()
+    ends = np.cumsum(lengths).tolist()
+
+    strings = strings + ["".join(NORMALIZE_PIECES[piece] for piece in pieces[end - length:end]) for end, length in zip(ends, lengths.tolist())]
+
+    for string in strings:
+        values = string.split(SEPARATOR)
+
+        expected = [reference_normalize(value) for value in values]
+        found = [value.strip() for value in normalize(string).split(SEPARATOR)]
+
+        if found != expected:
+            raise AssertionError(f"normalize('{string}') gives {found}, the replacements {expected}")
+
+
+def reference_signatures(binary_data: spmatrix, num_hashes: int) -> np.ndarray:
+    # Item.binary_to_signatures as one loop per hash function and nonzero, drawing (a, b) from the random module
+    # As floats, with inf for products without components
+    result = np.full([num_hashes, binary_data.shape[1]], float("inf"))
+    rows, cols = binary_data.nonzero()
+
+    for h in range(num_hashes):
+        a = random.randint(0, 100_000)
+        b = random.randint(0, 100_000)
+
+        for row, col in zip(rows, cols):
+            result[h, col] = min(custom_hash(row, a, b), result[h, col])
+
+    return result
+
+
+def check_signatures(products: list[Item], num_hashes: int = 24, seed: int = 0) -> None:
+    # A fixed seed of the random module gives the same signatures as the loop
+    binary_data = Item.minhash(products, filter_num = len(products), do_print = False)
+
+    random.seed(seed)
+    expected = reference_signatures(binary_data, num_hashes)
+
+    random.seed(seed)
+    signatures = Item.binary_to_signatures(binary_data, num_hashes, do_print = False)
+
+    expected[np.isinf(expected)] = EMPTY_SIGNATURE
+
+    if not np.array_equal(signatures, expected):
+        raise AssertionError(f"Signatures differ from the reference in {(signatures != expected).sum()} places")
+
+
+def reference_candidate_pairs(signatures: np.ndarray, num_bands: int, num_rows: int) -> set[tuple[int, int]]:
+    # All (i, j), i < j, pairs of products with the same signature values in all rows of any band
+    result: set[tuple[int, int]] = set()
+
+    for band in range(num_bands):
+        rows = signatures[band * num_rows:(band + 1) * num_rows]
+
+        buckets: dict[tuple[int, ...], list[int]] = {}
+        for product, key in enumerate(map(tuple, rows.T.tolist())):
+            buckets.setdefault(key, []).append(product)
+
+        for bucket in buckets.values():
+            result.update(combinations(bucket, 2))
+
+    return result
+
+
+def check_candidate_pairs(signatures: np.ndarray, num_bands: int, num_rows: int, chunk_size: int = 64) -> None:
+    # The chunks of iter_candidate_pairs together hold every pair of the brute force exactly once,
+    # small chunks such that pairs are spread over many of them
+    chunks = list(LSHIndex(signatures, num_bands, num_rows).iter_candidate_pairs(chunk_size))
+    pairs = np.concatenate([np.empty((0, 2), dtype = np.int32), *chunks])
+
+    found = set(map(tuple, pairs.tolist()))
+    expected = reference_candidate_pairs(signatures, num_bands, num_rows)
+
+    if len(found) != len(pairs):
+        raise AssertionError(f"{len(pairs) - len(found)} candidate pairs occur more than once")
+
+    if found != expected:
+        raise AssertionError(f"{len(found - expected)} candidate pairs too many, {len(expected - found)} missing")
+
+
+def check_coarsen(signatures: np.ndarray, all_num_rows: list[int]) -> None:
+    # Band hashes combined by LSHIndex.coarsen, directly and through nested_indices as the sweep does,
+    # equal those hashed from the signatures with that many rows per band
+    num_hashes = signatures.shape[0]
+
+    def check(index: LSHIndex) -> None:
+        expected = LSHIndex(signatures, num_hashes // index.num_rows, index.num_rows)
+
+        if not np.array_equal(index.band_hashes, expected.band_hashes):
+            raise AssertionError(f"Band hashes of {index.num_rows} rows differ from hashing from scratch")
+
+    for num_rows in all_num_rows:
+        index = LSHIndex(signatures, num_hashes // num_rows, num_rows)
+
+        for factor in range(2, index.num_bands + 1):
+            check(index.coarsen(factor))
+
+    for _, index in nested_indices(signatures, all_num_rows):
+        check(index)
+
+
+if __name__ == "__main__":
+    from solution import load_data
+
+    filename = "data/TVs-all-merged.json"
+    products, all_duplicates, num_products = load_data(filename)
+
+    # Titles and feature values, and all feature values of a product joined
+    with open(filename, "r") as file:
+        offers = list(read_json(file))
+
+    check_normalize([offer["title"] for offer in offers] + [SEPARATOR.join(offer["featuresMap"].values()) for offer in offers])
+    print("Normalisation: OK")
+
+    # The reference signatures take a Python loop per nonzero and hash function
+    check_signatures(products[:200])
+    print("Signatures: OK")
+
+    rng = np.random.default_rng(0)
+    signatures = Item.binary_to_signatures(Item.minhash(products, 500, do_print = False), 120, do_print = False, rng = rng)
+
+    # Few distinct values, such that there are large buckets as well
+    for candidate_signatures in (signatures, rng.integers(0, 3, size = (120, 500)).astype(np.uint32)):
+        for num_rows in (2, 4, 8):
+            check_candidate_pairs(candidate_signatures, 120 // num_rows, num_rows)
+
+    print("Candidate pairs: OK")
+
+    check_coarsen(signatures, [1, 2, 3, 4, 5, 6, 8, 12, 24])
+    print("Coarsened band hashes: OK")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from copy import copy
+
+from item import Item
+from pairs import subset_pairs
+
+
+def bootstrap_indices(num_products: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    # Sorted indices of the products drawn with replacement (train) and of those never drawn (test)
+    # Drawn in one call, a product drawn more than once is in train once
+    drawn = np.zeros(num_products, dtype = bool)
+    drawn[rng.integers(0, num_products, size = num_products)] = True
+
+    return np.flatnonzero(drawn), np.flatnonzero(~drawn)
+
+
+class BootstrapSplit():
+    """
+    Train/test split of the products for one bootstrap replicate, with the true duplicates of each side
+    as index pairs into that side. The ground truth is found by masking the canonical pairs of all
+    true duplicates, so preparing a split is linear in the number of products and duplicates.
+    """
+
+    def __init__(self, products: list[Item], all_duplicates: np.ndarray, rng: np.random.Generator):
+        num_products = len(products)
+
+        self.train_indices, self.test_indices = bootstrap_indices(num_products, rng)
+
+        # Copies, as minhash removes frequent components from the products it is given
+        self.train: list[Item] = [copy(products[i]) for i in self.train_indices]
+        self.test: list[Item] = [copy(products[i]) for i in self.test_indices]
+
+        self.duplicates_train = subset_pairs(all_duplicates, self.train_indices, num_products)
+        self.duplicates_test = subset_pairs(all_duplicates, self.test_indices, num_products)
+
+    def __str__(self) -> str:
+        return f"BootstrapSplit: train {len(self.train)} products, {len(self.duplicates_train)} duplicates, test {len(self.test)} products, {len(self.duplicates_test)} duplicates"
+
+    def __repr__(self) -> str:
+        return self.__str__()
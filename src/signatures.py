@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from scipy.sparse import csc_matrix, spmatrix
+
+
+# Signature value of products without any components
+# Signature values are below 2^31, so signatures are stored as uint32
+EMPTY_SIGNATURE = np.iinfo(np.uint32).max
+
+# Ways to compute signatures, see Item.binary_to_signatures
+SIGNATURE_METHODS = ("minhash", "oph")
+
+# Bit widths for which values don't straddle the 64 bit words they are packed in
+PACKED_BITS = (1, 2, 4, 8, 16, 32)
+
+# Number of set bits of every byte, for popcount without np.bitwise_count
+BYTE_BITS = np.array([bin(byte).count("1") for byte in range(256)], dtype = np.uint8)
+
+
+def mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finaliser, spreads values over all 64 bits
+    x = values.astype(np.uint64)
+
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+
+    return x
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    # Number of set bits of each uint64 value
+    # np.bitwise_count only exists from NumPy 2.0, before that the bits are counted per byte
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+
+    values = np.ascontiguousarray(values, dtype = np.uint64)
+
+    return BYTE_BITS[values.view(np.uint8)].reshape(*values.shape, 8).sum(axis = -1, dtype = np.uint8)
+
+
+def one_permutation_signatures(binary_data: spmatrix, num_hashes: int, seed: int, do_print: bool = True) -> np.ndarray:
+    # One permutation hashing with optimal densification (Shrivastava, 2017)
+    # Every component is hashed once, the high bits of the hash pick one of num_hashes bins and
+    # the low bits are its value, such that a signature value is the minimum over its bin.
+    # Empty bins then take the value of the first non-empty bin in a sequence of bins which
+    # only depends on the empty bin, which keeps the collision probability equal to the Jaccard similarity.
+    binary_data = csc_matrix(binary_data)
+    num_products = binary_data.shape[1]
+
+    hashes = mix(binary_data.indices.astype(np.uint64) ^ np.uint64(seed))
+    bins = ((hashes >> np.uint64(32)) * np.uint64(num_hashes)) >> np.uint64(32)
+
+    # 31 bits, such that no value equals EMPTY_SIGNATURE
+    values = ((hashes & np.uint64(0xFFFFFFFF)) >> np.uint64(1)).astype(np.uint32)
+
+    columns = np.repeat(np.arange(num_products), np.diff(binary_data.indptr))
+
+    result = np.full([num_hashes, num_products], EMPTY_SIGNATURE, dtype = np.uint32)
+    np.minimum.at(result, (bins.astype(np.int64), columns), values)
+
+    if do_print:
+        print(f"Empty bins: {(result == EMPTY_SIGNATURE).mean():.1%}")
+
+    # Densify, products without components stay empty
+    empty_bins, empty_columns = np.nonzero((result == EMPTY_SIGNATURE) & (np.diff(binary_data.indptr) > 0))
+
+    # Flat indices into result, of the empty bins and their column
+    empty = empty_bins * num_products + empty_columns
+    columns = empty_columns
+
+    flat = result.ravel()
+    filled = flat.copy()
+
+    all_bins = np.arange(num_hashes, dtype = np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+    attempt = 0
+    while len(empty) > 0:
+        attempt += 1
+
+        # Bin to borrow from for every bin, the same for all products
+        sources = (mix((all_bins + np.uint64(attempt)) ^ np.uint64(seed)) % np.uint64(num_hashes)).astype(np.int64)
+
+        borrowed = flat[sources[empty // num_products] * num_products + columns]
+
+        found = borrowed != EMPTY_SIGNATURE
+        filled[empty[found]] = borrowed[found]
+
+        empty, columns = empty[~found], columns[~found]
+
+    return filled.reshape(num_hashes, num_products)
+
+
+class PackedSignatures():
+    """
+    b-bit minwise hashing: only the lowest bits of every signature value are kept,
+    packed along the hash axis into 64 bit words, shape (num_words, num_products).
+    Indexing with rows returns those rows unpacked, such that band hashing only
+    unpacks the rows it needs. Two values agree by chance with probability 2^-bits,
+    which estimated_jaccard corrects for.
+    """
+
+    def __init__(self, signatures: np.ndarray, bits: int):
+        if bits not in PACKED_BITS:
+            raise ValueError(f"Can't pack {bits} bits, expected one of {PACKED_BITS}")
+
+        self.bits = bits
+        self.per_word = 64 // bits
+        self.num_hashes, self.num_products = signatures.shape
+
+        num_words = -(-self.num_hashes // self.per_word)
+        mask = np.uint64((1 << bits) - 1)
+
+        self.words = np.zeros([num_words, self.num_products], dtype = np.uint64)
+        for row in range(self.num_hashes):
+            word, slot = divmod(row, self.per_word)
+            self.words[word] |= (signatures[row].astype(np.uint64) & mask) << np.uint64(slot * bits)
+
+    def __str__(self) -> str:
+        return f"PackedSignatures: {self.num_hashes} hashes of {self.bits} bits, {self.num_products} products, {self.nbytes / 1e6:.1f} MB"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.num_hashes, self.num_products
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    def __getitem__(self, rows) -> np.ndarray:
+        # Values of the given rows (an int, slice or index array) of all products, as uint32
+        rows = np.arange(self.num_hashes)[rows]
+        word, slot = np.divmod(rows, self.per_word)
+
+        values = self.words[word] >> (slot * self.bits).astype(np.uint64)[..., None]
+
+        return (values & np.uint64((1 << self.bits) - 1)).astype(np.uint32)
+
+    def agreements(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        # Number of rows on which products first and second agree, by comparing whole words at once
+        differences = self.words[:, first] ^ self.words[:, second]
+
+        # Fold every value onto its lowest bit, which is then set if the value differs
+        for shift in (1, 2, 4, 8, 16):
+            if shift < self.bits:
+                differences |= differences >> np.uint64(shift)
+
+        lowest = np.uint64(sum(1 << (slot * self.bits) for slot in range(self.per_word)))
+        differing = popcount(differences & lowest).sum(axis = 0, dtype = np.int64)
+
+        # The unused slots of the last word are zero for both, so they agree
+        unused = len(self.words) * self.per_word - self.num_hashes
+
+        return len(self.words) * self.per_word - differing - unused
+
+    def estimated_jaccard(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        # Unbiased for a large number of components, where values agree by chance with probability 2^-bits
+        chance = 2.0 ** -self.bits
+        agreeing = self.agreements(first, second) / self.num_hashes
+
+        return np.clip((agreeing - chance) / (1 - chance), 0, 1)
@@ -1,136 +1,177 @@
 #!/usr/bin/env python3
 
 # Imports
-import json
 import warnings
 
-from itertools import combinations
 from math import comb
-from difflib import SequenceMatcher
-from collections import defaultdict
+from collections.abc import Iterable, Iterator
 
-import jellyfish
+import numpy as np
 
 from sklearn.linear_model import LogisticRegression
 
-from item import Item, Signature
+from blocking import blocked_candidate_pairs
+from cache import CachedRun, PipelineCache
+from clustering import clusters, evaluate_clusters, true_clusters
+from evaluation import ThresholdCurve
+from item import Item
+from ingest import StreamingLoader
+from features import SimilarityCache, similarity_features
+from lsh import LSHIndex, pair_similarity, top_k_pairs
+from pairs import count_common, pair_labels
+from profiling import profiled, stage
+from signatures import PackedSignatures
+from store import ProductStore
 
 warnings.filterwarnings("ignore", category = DeprecationWarning)
 
 
 def preprocess(products: list[Item]) -> None:
-    # Calculate weight/diagonal quantiles
-    Item.calc_quantiles(products)
+    # Weight/diagonal quantiles and brands found in titles, against the products themselves
+    weight_quantiles, diagonal_quantiles = Item.quantile_boundaries(products)
 
-    # Find brands for products which it wasn't found yet
-    all_brands: set[str] = set()
-    for product in products:
-        if product.brand:
-            all_brands.add(product.brand)
+    Item.prepare(products, weight_quantiles, diagonal_quantiles, Item.known_brands(products))
 
-    for product in products:
-        if not product.brand:
-            for brand in all_brands:
-                if brand in product.title:
-                    product.brand = brand
-                    break
 
-    # Get representation as set
-    for product in products:
-        product.find_set_representation()
-
-
-def load_data(filename: str) -> tuple[list[Item], set[tuple[Item]],  int]:
-    # Load in data
-    with open(filename, "r") as file:
-        data = json.load(file)
+@profiled("load_data", lambda result: {"products": result[2], "duplicates": len(result[1])})
+def load_data(filename: str, compact: bool = False) -> tuple[list[Item], np.ndarray, int]:
+    # The format of the file is derived from its extension, see ingest.StreamingLoader
+    # With compact, the preprocessed products are moved into a ProductStore
+    # and returned as StoredItem views on it, which use far less memory per product
 
+    # Load in data, keeping track of the products per modelID
+    loader = StreamingLoader(filename)
 
     # Get all item instances into big array
-    products = []
-
-    # Dict which contains modelID -> list of products with that modelID
-    duplicates: defaultdict[str, list] = defaultdict(list)
-
-    for key, val in data.items():
-        for product in val:
-            model_id = product["modelID"]
-            features = product["featuresMap"]
-            shop = product["shop"]
-            title = product["title"]
-
-            product_as_item = Item(model_id, features, shop, title)
+    products: list[Item] = [product for batch in loader.batches() for product in batch]
 
-            products.append(product_as_item)
-
-            duplicates[model_id].append(product_as_item)
-
-    # Get set of all duplicates
-    all_duplicates: set[tuple[Item]] = set()
-    for items in duplicates.values():
-        for item, other_item in combinations(items, 2):
-            all_duplicates.add((item, other_item))
+    # Get all duplicates as (i, j) index pairs
+    all_duplicates = loader.duplicates()
 
     num_duplicates = len(all_duplicates)
     print(f"Total number of duplicates: {num_duplicates} / {comb(len(products), 2)}")
 
     preprocess(products)
 
+    if compact:
+        products = ProductStore(products).items()
+
     return products, all_duplicates, len(products)
 
 
-def minhash(products: list[Item], num_hashes: int, filter_num: int = 500, do_print: bool = True) -> list[Signature]:
+def minhash(products: list[Item], num_hashes: int, filter_num: int = 500, do_print: bool = True,
+            rng: np.random.Generator = None, with_second: bool = False, bits: int = None,
+            method: str = "minhash") -> np.ndarray | PackedSignatures | tuple[np.ndarray, np.ndarray]:
+    # Hash functions are drawn from rng if given, otherwise from the random module
+    # method is "minhash" or "oph" (one permutation hashing), see Item.binary_to_signatures
+    # With with_second, returns the signatures and second smallest hash values, for multi-probe LSH
+    # With bits, returns only the lowest bits of the signatures, packed (b-bit minwise hashing)
+    if with_second and bits is not None:
+        raise ValueError("Multi-probe LSH needs the full signatures, can't pack them")
+
     binary_data = Item.minhash(products, filter_num, do_print)
 
     if do_print:
         print("Calculating signatures")
-    signatures = Item.binary_to_signatures(binary_data, num_hashes, do_print)
+    signatures = Item.binary_to_signatures(binary_data, num_hashes, do_print, rng = rng, with_second = with_second, method = method)
+
+    if bits is not None:
+        signatures = PackedSignatures(signatures, bits)
 
     if do_print:
         print("Done calculating signatures")
 
-    result = []
-    for signature in signatures.T:
-        result.append(Signature(signature))
+    return signatures
 
-    return result
 
 
+def load_cached(filename: str, num_hashes: int, filter_num: int = 500, seed: int = 0, cache: PipelineCache = None,
+                method: str = "minhash", do_print: bool = True) -> tuple[list[Item], np.ndarray, int, np.ndarray]:
+    # load_data followed by minhash, served from the on-disk cache if this file was processed
+    # with the same parameters before, otherwise computed and stored in the cache
+    if cache is None:
+        cache = PipelineCache()
 
-def LSH(products: list[Item], signatures: list[Signature], num_bands: int, num_rows: int) -> set[tuple[Item, Item]]:
-    buckets: defaultdict[int, list[Item]] = defaultdict(list)
+    key = cache.key(filename, filter_num, num_hashes, seed, method)
+    run = cache.load(key)
 
-    for i, signature in enumerate(signatures):
-        hashes = signature.hashes(num_bands, num_rows)
-        for subvector_hash in hashes:
-            buckets[subvector_hash].append(products[i])
+    if run is not None:
+        if do_print:
+            print(f"Loaded from cache: {run}")
 
-    # Aggregate buckets
-    result: set[tuple[Item, Item]] = set()
-    for _, bucket in buckets.items():
-        for item, other_item in combinations(bucket, 2):
-            result.add((item, other_item))
+        return run.products, run.all_duplicates, len(run.products), run.signatures
 
-    return result
+    products, all_duplicates, num_products = load_data(filename)
 
+    binary_data, vocabulary = Item.binary_matrix(products, filter_num, do_print)
+    signatures = Item.binary_to_signatures(binary_data, num_hashes, do_print, rng = np.random.default_rng(seed), method = method)
+
+    cache.store(key, CachedRun(products, all_duplicates, vocabulary, binary_data, signatures))
+
+    return products, all_duplicates, num_products, signatures
 
-def evaluate(found_duplicates: set[tuple[Item, Item]], all_duplicates: set[tuple[Item, Item]], num_products: int, do_print: bool = True) -> list[float]:
-    # F1-score
-    FP = FN = TP = TN = 0
 
-    # Find TP and FP
-    for pair in found_duplicates:
-        if pair in all_duplicates:
-            TP += 1
+def LSH(signatures: np.ndarray | PackedSignatures, num_bands: int, num_rows: int, top_k: int = None, min_similarity: float = 0,
+        num_probes: int = 0, second_signatures: np.ndarray = None) -> np.ndarray:
+    # With top_k or min_similarity, candidates are ranked by the similarity estimated from their signatures,
+    # keeping those among the top_k of either product with at least min_similarity, most similar first
+    # With num_probes, also pairs in the num_probes buckets next to each product's are candidates,
+    # which needs the second smallest hash values from minhash(..., with_second = True)
+    index = LSHIndex(signatures, num_bands, num_rows)
+
+    if num_probes > 0:
+        candidates = index.multi_probe_pairs(signatures, second_signatures, num_probes)
+    else:
+        candidates = index.candidate_pairs()
+
+    if top_k is None and min_similarity == 0:
+        return candidates
+
+    return top_k_pairs(candidates, pair_similarity(signatures, candidates), index.num_products, top_k, min_similarity)[0]
+
+
+def LSH_stream(signatures: np.ndarray, num_bands: int, num_rows: int, chunk_size: int = 1 << 22, max_bucket_size: int = None,
+               oversized: str = "skip", rng: np.random.Generator = None, do_print: bool = True) -> Iterator[np.ndarray]:
+    # Same candidates as LSH, but yielded in chunks with memory bounded by chunk_size
+    index = LSHIndex(signatures, num_bands, num_rows)
+
+    yield from index.iter_candidate_pairs(chunk_size, max_bucket_size, oversized, rng)
+
+    if do_print:
+        print(f"Pairs per band: {index.pairs_per_band.tolist()}")
+
+
+def multi_probe_tradeoff(signatures: np.ndarray, second_signatures: np.ndarray, all_duplicates: np.ndarray,
+                         num_bands: int, num_rows: int, max_probes: int = None, do_print: bool = True) -> np.ndarray:
+    # Candidates found with 0 .. max_probes probes per band, rows of
+    # (num_probes, number of candidates, comparison ratio, recall)
+    if max_probes is None:
+        max_probes = num_rows
+
+    index = LSHIndex(signatures, num_bands, num_rows)
+    num_products = index.num_products
+
+    result = np.empty([max_probes + 1, 4])
+    for num_probes in range(max_probes + 1):
+        if num_probes > 0:
+            candidates = index.multi_probe_pairs(signatures, second_signatures, num_probes)
         else:
-            FP += 1
+            candidates = index.candidate_pairs()
+
+        recall = count_common(candidates, all_duplicates, num_products) / max(len(all_duplicates), 1)
+        result[num_probes] = [num_probes, len(candidates), len(candidates) / comb(num_products, 2), recall]
 
-    # Find FN
-    for pair in all_duplicates:
-        if pair not in found_duplicates:
-            FN += 1
+        if do_print:
+            print(f"{num_rows} rows, {num_probes} probes: {len(candidates)} candidates, comparison ratio {result[num_probes, 2]:.2%}, recall {recall:.1%}")
 
-    # Find TN
+    return result
+
+
+def evaluate(found_duplicates: np.ndarray, all_duplicates: np.ndarray, num_products: int, do_print: bool = True) -> list[float]:
+    # F1-score
+    TP = count_common(found_duplicates, all_duplicates, num_products)
+    FP = len(found_duplicates) - TP
+    FN = len(all_duplicates) - TP
     TN = comb(num_products, 2) - FN - FP - TP
 
     if do_print:
@@ -161,54 +202,100 @@ def evaluate(found_duplicates: set[tuple[Item, Item]], all_duplicates: set[tuple
     return precision, recall, F1
 
 
-def similarity_scores(pair: tuple[Item, Item]) -> list[int]:
-    item, other_item = pair
+def _scored_chunks(products: list[Item], intermediate_duplicates: np.ndarray | Iterable[np.ndarray], all_duplicates: np.ndarray,
+                   weight: float, predictor: LogisticRegression, num_workers: int, chunk_size: int, cache: SimilarityCache,
+                   do_print: bool) -> tuple[Iterator[tuple[np.ndarray, np.ndarray]], LogisticRegression]:
+    # Predictor, fitted if not provided, and the chunks of candidates with their predicted duplicate probability
+    # The chunks are scored lazily, such that with a provided predictor only one chunk is in memory at a time
+    if isinstance(intermediate_duplicates, np.ndarray):
+        chunks = [intermediate_duplicates]
+    else:
+        chunks = intermediate_duplicates
+
+    # Use provided predictor, otherwise fit model
+    fitted_features = None
+    if not predictor:
+        # Fitting needs all candidates at once
+        intermediate_duplicates = np.concatenate([np.empty((0, 2), dtype = np.int32), *chunks])
+        features = similarity_features(products, intermediate_duplicates, num_workers, chunk_size, cache)
 
-    if item.shop == other_item.shop:
-        return [0, 0]
+        with stage("fit") as record:
+            predictor = LogisticRegression(class_weight = {0: weight, 1: 1}).fit(
+                features,
+                pair_labels(intermediate_duplicates, all_duplicates, len(products))
+            )
 
-    if item.brand != other_item.brand:
-        return [0, 0]
+            record.count(pairs = len(features))
 
+        # Reuse the features for classification
+        chunks = [intermediate_duplicates]
+        fitted_features = features
 
-    representation, other_representation = [sorted(list(item.set_representation)) for item in pair]
-    similarity_SM = SequenceMatcher(None, representation, other_representation).ratio()
+    if do_print:
+        print(f"Logit model coefficients: {predictor.intercept_} {predictor.coef_}")
 
-    title, other_title = [item.title.replace(" ", "").lower() for item in pair]
-    similarity_JW = jellyfish.jaro_winkler_similarity(title, other_title)
+    def scored() -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
 
-    return [similarity_SM, similarity_JW]
+            if fitted_features is not None:
+                features = fitted_features
+            else:
+                features = similarity_features(products, chunk, num_workers, chunk_size, cache)
 
-def duplicate_detection(intermediate_duplicates: set[tuple[Item, Item]], all_duplicates: set[tuple[Item, Item]], weight: float = 1, threshold: float = 0.06,
-                        predictor: LogisticRegression = None, do_print: bool = True) -> tuple[set[tuple[Item, Item]], LogisticRegression]:
-    if do_print:
-        print("Detecting duplicates")
+            with stage("predict_proba") as record:
+                similarity = predictor.predict_proba(features)[:, 1]
+                record.count(pairs = len(features))
 
-    # Use provided predictor, otherwise fit model
-    if not predictor:
-        predictor = LogisticRegression(class_weight = {0: weight, 1: 1}).fit(
-            [similarity_scores(pair) for pair in intermediate_duplicates],
-            [pair in all_duplicates for pair in intermediate_duplicates]
-        )
+            yield chunk, similarity
 
-    if do_print:
-        print(f"Logit model coefficients: {predictor.intercept_} {predictor.coef_}")
+    return scored(), predictor
 
 
-    final_duplicates: set[tuple[Item]] = set()
-    for i, pair in enumerate(intermediate_duplicates):
-        if do_print:
-            print(f"{i} ({i / len(intermediate_duplicates):.1%})", end = "\r")
+def candidate_scores(products: list[Item], intermediate_duplicates: np.ndarray | Iterable[np.ndarray], all_duplicates: np.ndarray,
+                     weight: float = 1, predictor: LogisticRegression = None,
+                     num_workers: int = 1, chunk_size: int = 10_000, cache: SimilarityCache = None,
+                     do_print: bool = True) -> tuple[np.ndarray, np.ndarray, LogisticRegression]:
+    # All candidates with their predicted duplicate probability, for evaluation.ThresholdCurve
+    # Arguments are as for duplicate_detection
+    chunks, predictor = _scored_chunks(products, intermediate_duplicates, all_duplicates, weight, predictor,
+                                       num_workers, chunk_size, cache, do_print)
 
-        similarity = predictor.predict_proba([similarity_scores(pair)])[0][1]
+    pairs: list[np.ndarray] = [np.empty((0, 2), dtype = np.int32)]
+    scores: list[np.ndarray] = [np.empty(0)]
+    for chunk, similarity in chunks:
+        pairs.append(chunk)
+        scores.append(similarity)
 
-        if similarity > threshold:
-            final_duplicates.add(pair)
+    return np.concatenate(pairs), np.concatenate(scores), predictor
+
+
+def duplicate_detection(products: list[Item], intermediate_duplicates: np.ndarray | Iterable[np.ndarray], all_duplicates: np.ndarray,
+                        weight: float = 1, threshold: float = 0.06, predictor: LogisticRegression = None,
+                        num_workers: int = 1, chunk_size: int = 10_000, cache: SimilarityCache = None,
+                        do_print: bool = True) -> tuple[np.ndarray, LogisticRegression]:
+    # intermediate_duplicates is either a pair array or an iterable of chunks thereof (see LSH_stream)
+    # With a provided predictor, chunks are classified one at a time
+    # num_workers, chunk_size and cache are passed on to similarity_features
+    # To try several thresholds, use candidate_scores with evaluation.ThresholdCurve instead
+    if do_print:
+        print("Detecting duplicates")
+
+    chunks, predictor = _scored_chunks(products, intermediate_duplicates, all_duplicates, weight, predictor,
+                                       num_workers, chunk_size, cache, do_print)
+
+    final_duplicates: list[np.ndarray] = [np.empty((0, 2), dtype = np.int32)]
+    for chunk, similarity in chunks:
+        final_duplicates.append(chunk[similarity > threshold])
 
     if do_print:
         print("Done checking duplicates")
 
-    return final_duplicates, predictor
+        if cache is not None:
+            print(cache)
+
+    return np.concatenate(final_duplicates), predictor
 
 
 if __name__ == "__main__":
@@ -223,14 +310,26 @@ if __name__ == "__main__":
 
     filename = "data/TVs-all-merged.json"
 
+    # Seed of the hash functions
+    seed = 0
 
-    products, all_duplicates, num_products = load_data(filename)
+    # Classification threshold on the predicted duplicate probability
+    threshold = 0.06
+
+    # LSH within blocks of products of the same brand, with this fallback for products without one,
+    # see blocking.py, None for LSH over all products
+    blocking = None
 
-    print()
 
-    signatures = minhash(products, num_hashes)
+    # Preprocessed products and signatures are cached in data/cache, keyed by the file and parameters
+    products, all_duplicates, num_products, signatures = load_cached(filename, num_hashes, seed = seed)
+
+    print()
 
-    intermediate_duplicates = LSH(products, signatures, num_bands, num_rows)
+    if blocking is None:
+        intermediate_duplicates = LSH(signatures, num_bands, num_rows)
+    else:
+        intermediate_duplicates = blocked_candidate_pairs(LSHIndex(signatures, num_bands, num_rows), products, blocking)
 
     print()
 
@@ -239,6 +338,16 @@ if __name__ == "__main__":
     print(f"Comparison ratio: {len(intermediate_duplicates) / comb(len(products), 2):.1%}")
     print()
 
-    final_duplicates, predictor = duplicate_detection(intermediate_duplicates, all_duplicates)
+    # Scores of all candidates, classified at threshold as by duplicate_detection, and at every threshold
+    # to see which would have been best
+    pairs, scores, predictor = candidate_scores(products, intermediate_duplicates, all_duplicates)
+    final_duplicates = pairs[scores > threshold]
 
     evaluate(final_duplicates, all_duplicates, num_products)
+
+    print(ThresholdCurve(pairs, scores, all_duplicates, num_products))
+    print()
+
+    # Clusters of duplicates, with at most one offer per shop
+    labels = clusters(final_duplicates, products, scores[scores > threshold])
+    evaluate_clusters(labels, true_clusters(products))
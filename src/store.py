@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from sys import intern
+
+from item import Item
+
+
+class ProductStore():
+    """
+    Columnar storage of preprocessed products.
+    Numeric attributes are arrays, strings are interned and set representations are stored
+    as a CSR layout of component ids, instead of a dict, set and tuple per product.
+    Missing values are NaN for floats and -1 for ids and quantiles.
+    """
+
+    def __init__(self, products: list[Item]):
+        num_products = len(products)
+
+        self.ids = [intern(product.id) for product in products]
+        self.titles = [intern(product.title) for product in products]
+
+        self.shop_names, self.shop_ids = self._encode([product.shop for product in products], np.int32)
+        self.brand_names, self.brand_ids = self._encode([product.brand for product in products], np.int32)
+
+        self.weights = np.array([np.nan if product.weight is None else product.weight for product in products])
+        self.diagonals = np.array([np.nan if product.diagonal is None else product.diagonal for product in products])
+        self.refresh_rates = np.array([np.nan if product.refresh_rate is None else product.refresh_rate for product in products])
+
+        self.weight_quantiles = np.array([-1 if product.weight_quantile is None else product.weight_quantile for product in products], dtype = np.int8)
+        self.diagonal_quantiles = np.array([-1 if product.diagonal_quantile is None else product.diagonal_quantile for product in products], dtype = np.int8)
+
+        # Sorted vocabulary, such that sorted component ids are also sorted as strings
+        self.vocabulary = sorted({intern(component) for product in products for component in product.set_representation})
+        component_ids = {component: i for i, component in enumerate(self.vocabulary)}
+
+        self.component_indptr = np.zeros(num_products + 1, dtype = np.int64)
+        self.component_indptr[1:] = np.cumsum([len(product.set_representation) for product in products])
+
+        self.component_ids = np.empty(self.component_indptr[-1], dtype = np.int32)
+        for i, product in enumerate(products):
+            self.component_ids[self.component_indptr[i]:self.component_indptr[i + 1]] = sorted(
+                component_ids[component] for component in product.set_representation
+            )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __str__(self) -> str:
+        return f"ProductStore: {len(self)} products, {len(self.vocabulary)} components"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @staticmethod
+    def _encode(values: list[str], dtype: type) -> tuple[list[str], np.ndarray]:
+        # Distinct non-None values and the index of each value into those, -1 for None
+        names = sorted({value for value in values if value is not None})
+        ids = {name: i for i, name in enumerate(names)}
+
+        return [intern(name) for name in names], np.array([ids.get(value, -1) for value in values], dtype = dtype)
+
+    def components(self, index: int) -> np.ndarray:
+        # Sorted ids of all components of a product
+        return self.component_ids[self.component_indptr[index]:self.component_indptr[index + 1]]
+
+    def items(self) -> list[StoredItem]:
+        return [StoredItem(self, i) for i in range(len(self))]
+
+
+class StoredItem():
+    """
+    View on a product in a ProductStore, with the same accessors as a preprocessed Item.
+    The raw features are not kept, as nothing uses them after preprocessing.
+    The store is never changed through a view: components removed from a view (see Item.minhash)
+    are masked out by a mask of the view itself, which is replaced rather than updated,
+    such that copies of a view don't share the change, like copies of an Item.
+    """
+
+    __slots__ = ("store", "index", "active")
+
+    def __init__(self, store: ProductStore, index: int):
+        self.store = store
+        self.index = index
+
+        # Which of the product's components are still there, None while all of them are
+        self.active: np.ndarray = None
+
+    def __str__(self) -> str:
+        return f"Item: '{self.id}' ('{self.shop}')"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __hash__(self) -> int:
+        return hash(self.title) + hash(self.shop) + hash(self.id)
+
+    def __eq__(self, other) -> bool:
+        return self.id == other.id
+
+    @property
+    def id(self) -> str:
+        return self.store.ids[self.index]
+
+    @property
+    def title(self) -> str:
+        return self.store.titles[self.index]
+
+    @property
+    def shop(self) -> str:
+        return self.store.shop_names[self.store.shop_ids[self.index]]
+
+    @property
+    def brand(self) -> str:
+        brand_id = self.store.brand_ids[self.index]
+
+        return None if brand_id == -1 else self.store.brand_names[brand_id]
+
+    @property
+    def weight(self) -> float:
+        weight = self.store.weights[self.index]
+
+        return None if np.isnan(weight) else float(weight)
+
+    @property
+    def diagonal(self) -> float:
+        diagonal = self.store.diagonals[self.index]
+
+        return None if np.isnan(diagonal) else float(diagonal)
+
+    @property
+    def refresh_rate(self) -> float:
+        refresh_rate = self.store.refresh_rates[self.index]
+
+        return None if np.isnan(refresh_rate) else float(refresh_rate)
+
+    @property
+    def weight_quantile(self) -> int:
+        quantile = self.store.weight_quantiles[self.index]
+
+        return None if quantile == -1 else int(quantile)
+
+    @property
+    def diagonal_quantile(self) -> int:
+        quantile = self.store.diagonal_quantiles[self.index]
+
+        return None if quantile == -1 else int(quantile)
+
+    @property
+    def set_representation(self) -> set[str]:
+        return set(self.sorted_representation)
+
+    @set_representation.setter
+    def set_representation(self, value: set[str]) -> None:
+        # Only removing components is supported, which is all Item.minhash does
+        if not value <= self.set_representation:
+            raise ValueError("Can only remove components from a stored product")
+
+        components = self.store.components(self.index)
+        self.active = np.array([self.store.vocabulary[i] in value for i in components.tolist()], dtype = bool)
+
+    def _component_ids(self) -> np.ndarray:
+        components = self.store.components(self.index)
+
+        return components if self.active is None else components[self.active]
+
+    @property
+    def sorted_representation(self) -> tuple[str, ...]:
+        return tuple(self.store.vocabulary[i] for i in self._component_ids())
+
+    @property
+    def normalized_title(self) -> str:
+        return self.title.replace(" ", "").lower()
+
+    def cache_similarity_inputs(self) -> None:
+        # Similarity inputs are derived from the store on access
+        pass
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import numpy as np
+
+from math import comb
+from collections.abc import Iterator
+
+from blocking import blocked_candidate_pairs
+from item import Item
+from lsh import LSHIndex
+from profiling import stage
+from evaluation import CURVE_COLUMNS, THRESHOLDS, ThresholdCurve
+from solution import candidate_scores, duplicate_detection, evaluate, minhash
+
+
+# Columns of the results of a sweep, as read by plotter.py
+RESULT_COLUMNS = ("comparison_ratio", "precision_star", "recall_star", "F1_star", "precision", "recall", "F1")
+
+
+def nested_indices(signatures: np.ndarray, all_num_rows: list[int]) -> Iterator[tuple[int, LSHIndex]]:
+    # LSH indices with as many bands as fit for each num_rows, in the order of all_num_rows
+    # Band hashes of a num_rows that is a multiple of an earlier one are combined from that one's,
+    # e.g. 8 rows from 4 rows from 2 rows, instead of hashing the signatures again
+    num_hashes = signatures.shape[0]
+    indices: dict[int, LSHIndex] = {}
+
+    for num_rows in all_num_rows:
+        divisors = [rows for rows in indices if num_rows % rows == 0]
+
+        if divisors:
+            rows = max(divisors)
+            index = indices[rows].coarsen(num_rows // rows)
+        else:
+            index = LSHIndex(signatures, num_hashes // num_rows, num_rows)
+
+        indices[num_rows] = index
+
+        yield num_rows, index
+
+
+class Sweep():
+    """
+    Evaluation of all (num_bands, num_rows) configurations on one train/test split.
+    Signatures are computed once per split and shared by all configurations.
+    Besides the results at threshold, the precision, recall and F1 at all THRESHOLDS are kept per configuration.
+    With blocking, one of BLOCKING_FALLBACKS, candidates are only found within blocks of products of the same brand,
+    see blocking.py.
+    """
+
+    def __init__(self, train: list[Item], test: list[Item], duplicates_train: np.ndarray, duplicates_test: np.ndarray,
+                 num_hashes: int, weight: float = 1, threshold: float = 0.06, rng: np.random.Generator = None,
+                 method: str = "minhash", blocking: str = None, do_print: bool = True):
+        self.train = train
+        self.test = test
+        self.duplicates_train = duplicates_train
+        self.duplicates_test = duplicates_test
+        self.weight = weight
+        self.threshold = threshold
+        self.blocking = blocking
+        self.do_print = do_print
+
+        self.signatures_train = minhash(train, num_hashes, do_print = do_print, rng = rng, method = method)
+        self.signatures_test = minhash(test, num_hashes, do_print = do_print, rng = rng, method = method)
+
+    def __str__(self) -> str:
+        return f"Sweep: {len(self.train)} train, {len(self.test)} test products, {self.signatures_train.shape[0]} hashes"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def candidate_pairs(self, index: LSHIndex, products: list[Item]) -> np.ndarray:
+        if self.blocking is None:
+            return index.candidate_pairs()
+
+        return blocked_candidate_pairs(index, products, self.blocking)
+
+    def evaluate(self, index_train: LSHIndex, index_test: LSHIndex) -> tuple[list[float], np.ndarray]:
+        # One row of results, see RESULT_COLUMNS, and the curve at THRESHOLDS, see CURVE_COLUMNS
+        num_train, num_test = len(self.train), len(self.test)
+
+        intermediate_duplicates_train = self.candidate_pairs(index_train, self.train)
+        comparison_ratio_train = len(intermediate_duplicates_train) / comb(num_train, 2)
+
+        if self.do_print:
+            print(f"Comparison ratio: {comparison_ratio_train:.1%}")
+
+        precision_star, _, _ = evaluate(intermediate_duplicates_train, self.duplicates_train, num_train, do_print = self.do_print)
+
+        # Can't do logit if we have 0 TP in training data
+        if precision_star == 0:
+            return [comparison_ratio_train, 0, 0, 0, 0, 0, 0], np.zeros([len(THRESHOLDS), len(CURVE_COLUMNS)])
+
+        _, predictor = duplicate_detection(self.train, intermediate_duplicates_train, self.duplicates_train, weight = self.weight, do_print = self.do_print)
+
+        # Apply model to testing data
+        intermediate_duplicates_test = self.candidate_pairs(index_test, self.test)
+        comparison_ratio_test = len(intermediate_duplicates_test) / comb(num_test, 2)
+
+        precision_star, recall_star, F1_star = evaluate(intermediate_duplicates_test, self.duplicates_test, num_test, do_print = self.do_print)
+
+        if self.do_print:
+            print(f"Comparison ratio: {comparison_ratio_test:.1%}")
+
+        # Scored once, for the results at threshold as well as the curve
+        pairs, scores, _ = candidate_scores(self.test, intermediate_duplicates_test, self.duplicates_test, predictor = predictor, do_print = self.do_print)
+        curve = ThresholdCurve(pairs, scores, self.duplicates_test, num_test)
+
+        precision, recall, F1 = evaluate(pairs[scores > self.threshold], self.duplicates_test, num_test, do_print = self.do_print)
+
+        if self.do_print:
+            print(curve)
+
+        return [comparison_ratio_test, precision_star, recall_star, F1_star, precision, recall, F1], curve.at(THRESHOLDS)
+
+    def run(self, all_num_rows: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        # Results of each num_rows, shape (len(all_num_rows), len(RESULT_COLUMNS)),
+        # and curves of each num_rows, shape (len(all_num_rows), len(THRESHOLDS), len(CURVE_COLUMNS))
+        # Divisors are processed in increasing order, such that nested ones reuse band hashes
+        order = sorted(range(len(all_num_rows)), key = lambda i: all_num_rows[i])
+        ordered = [all_num_rows[i] for i in order]
+
+        results = np.empty([len(all_num_rows), len(RESULT_COLUMNS)])
+        curves = np.empty([len(all_num_rows), len(THRESHOLDS), len(CURVE_COLUMNS)])
+
+        indices = zip(nested_indices(self.signatures_train, ordered), nested_indices(self.signatures_test, ordered))
+        for k, (i, ((num_rows, index_train), (_, index_test))) in enumerate(zip(order, indices)):
+            print(f"{k + 1} / {len(all_num_rows)}: {num_rows} rows")
+
+            if self.do_print:
+                print(f"(Approximate) LSH Acceptance threshold: {(1 / index_train.num_bands) ** (1 / num_rows):.4f}")
+
+            # Stages within are recorded per num_rows
+            with stage(f"{num_rows} rows"):
+                results[i], curves[i] = self.evaluate(index_train, index_test)
+
+            if self.do_print:
+                print()
+
+        return results, curves
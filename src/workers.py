@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Data shared by all tasks in a worker process, by name, sent once per worker by _init_worker
+_worker_data: dict[str, object] = {}
+
+
+def _init_worker(data: dict[str, object]) -> None:
+    _worker_data.update(data)
+
+
+def worker_pool(num_workers: int, **data) -> ProcessPoolExecutor:
+    # Process pool of which every worker gets data once when it starts, instead of with every task
+    # Tasks read it with worker_data, so they can be module level functions taking only what differs per task
+    return ProcessPoolExecutor(num_workers, initializer = _init_worker, initargs = (data,))
+
+
+def worker_data(name: str) -> object:
+    return _worker_data[name]